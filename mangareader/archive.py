@@ -0,0 +1,320 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Read pages straight out of zip (cbz) archives, without extracting them.
+
+    An archive is opened once: its central directory is read into an index of
+    members, and the file is memory mapped. Reading a member is then a matter of
+    slicing the map (and inflating, for compressed members), which is safe to do
+    from several threads at the same time, since nothing seeks.
+
+    Pages inside archives have paths like any other page, with the archive acting
+    as a directory:
+
+        /path/to/manga/chapter 01.cbz/003.jpg
+
+    `split_path` tells such paths apart, and `open_file` opens either kind.
+
+    Open archives are shared through a pool (see `ArchivePool`), which keeps the 
+    number of open file descriptors bounded.
+
+    Archives inside archives are not supported (they're just skipped).
+"""
+
+import os, mmap, struct, threading, zipfile, zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+ARCHIVE_EXTENSIONS = ('.zip', '.cbz')
+CHUNK_SIZE = 16 * 1024 # how much compressed data we inflate at a time for partial reads
+
+class ArchiveError(IOError): pass
+
+def is_archive(path):
+    """Does the path look like an archive we can read? (by its extension only)"""
+    _, ext = os.path.splitext(path)
+    return ext.lower() in ARCHIVE_EXTENSIONS
+
+def member_path(archive_path, member):
+    """The path of a member (a '/' separated name inside the archive)"""
+    if not member: return archive_path
+    return os.path.join(archive_path, *member.split('/'))
+
+def split_path(path):
+    """ (archive path, member name) if path points inside an archive, None otherwise
+
+        Only path components that look like archives cost a stat, and only the first time
+    """
+    members = []
+    head = path
+    while True:
+        head, name = os.path.split(head)
+        if not name: return None
+        members.insert(0, name)
+        if is_archive(head) and _is_archive_file(head):
+            return head, '/'.join(members)
+
+_known_files = {} # archive-looking path -> whether it's actually a file
+
+def _is_archive_file(path):
+    if not _known_files.has_key(path):
+        _known_files[path] = os.path.isfile(path)
+    return _known_files[path]
+
+class MemberFile(object):
+    """ A read-only file object for an archive member. Compressed members are inflated
+        only as far as they're read, so reading a header doesn't cost the whole page
+    """
+    def __init__(self, raw, compressed):
+        self.raw = raw # the member data, as stored in the archive
+        self.pos = 0
+        self.on_close = None # called once, when the file is closed
+        if compressed:
+            self.data = ''
+            self.inflater = zlib.decompressobj(-15)
+            self.consumed = 0
+        else:
+            self.data = raw
+            self.inflater = None
+
+    def _fill(self, size=None):
+        """inflate until we have `size` bytes (all of them if size is None)"""
+        if self.inflater is None: return
+        try:
+            self._inflate(size)
+        except zlib.error, e:
+            raise ArchiveError(str(e))
+
+    def _inflate(self, size):
+        if size is None:
+            self.data += self.inflater.decompress(self.raw[self.consumed:]) + self.inflater.flush()
+            self.inflater = None
+            return
+        pieces = [self.data]
+        available = len(self.data)
+        while available < size:
+            chunk = self.raw[self.consumed:self.consumed + CHUNK_SIZE]
+            if not chunk:
+                pieces.append(self.inflater.flush())
+                self.inflater = None
+                break
+            self.consumed += len(chunk)
+            piece = self.inflater.decompress(chunk)
+            pieces.append(piece)
+            available += len(piece)
+        self.data = ''.join(pieces)
+
+    def read(self, size=-1):
+        end = None if size is None or size < 0 else self.pos + size
+        self._fill(end)
+        result = self.data[self.pos:end]
+        self.pos += len(result)
+        return str(result)
+
+    def seek(self, offset, whence=0):
+        if whence == 1: offset += self.pos
+        elif whence == 2:
+            self._fill()
+            offset += len(self.data)
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.raw = self.data = None
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ZipArchive(object):
+    """ A zip file, opened for random access
+
+        @raises ArchiveError: if the file can't be read as a zip
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                infos = zipfile.ZipFile(f).infolist() # reads the central directory
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (zipfile.BadZipfile, IOError, mmap.error), e:
+            raise ArchiveError("can't read %s: %s" % (path, e))
+        self.members = {} # name -> ZipInfo, for files
+        self.dirs = {'': {}} # directory name -> {child name: isdir}
+        for info in infos:
+            name = info.filename.replace('\\', '/')
+            if isinstance(name, unicode): # zipfile decodes names flagged as utf-8
+                name = name.encode('utf-8') # the tree's paths are byte strings
+            if name.startswith('__MACOSX/'): continue # resource forks, not pages
+            isdir = name.endswith('/')
+            name = name.rstrip('/')
+            if not name: continue
+            if not isdir:
+                self.members[name] = info
+            self._add_entry(name, isdir)
+
+    def _add_entry(self, name, isdir):
+        parent, _, base = name.rpartition('/')
+        if isdir: self.dirs.setdefault(name, {})
+        if not self.dirs.has_key(parent): # a directory without its own entry
+            self._add_entry(parent, True)
+        self.dirs[parent][base] = isdir
+
+    def listing(self, directory=''):
+        """The entries of a directory in the archive, as a list of (name, isdir)"""
+        return self.dirs.get(directory, {}).items()
+
+    def _member_data(self, name):
+        """(raw data, compressed?) of the member called name"""
+        info = self.members.get(name)
+        if info is None: raise ArchiveError("%s has no member %s" % (self.path, name))
+        if info.flag_bits & 0x1: raise ArchiveError("%s is encrypted" % name)
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ArchiveError("%s: unsupported compression" % name)
+        offset = info.header_offset
+        header = self.map[offset:offset + 30]
+        if len(header) < 30 or header[:4] != 'PK\x03\x04':
+            raise ArchiveError("%s: bad local header for %s" % (self.path, name))
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        start = offset + 30 + name_length + extra_length
+        return buffer(self.map, start, info.compress_size), info.compress_type == zipfile.ZIP_DEFLATED
+
+    def read(self, name):
+        """The contents of the member called name, as a string"""
+        return str(self.read_buffer(name))
+
+    def read_buffer(self, name):
+        """ The contents of the member called name. For stored (uncompressed) members,
+            that's a buffer straight over the memory map: no copy, but it's only
+            valid while the archive is open (i.e. while you hold it from the pool)
+        """
+        raw, compressed = self._member_data(name)
+        if not compressed: return raw
+        try:
+            return zlib.decompress(raw, -15)
+        except zlib.error, e:
+            raise ArchiveError("%s: %s" % (name, e))
+
+    def open(self, name):
+        """A file object for the member called name"""
+        return MemberFile(*self._member_data(name))
+
+    def close(self):
+        self.map.close()
+
+class ArchivePool(object):
+    """ The open archives, shared by path.
+
+        Every archive is opened (and mapped) once, no matter how many pages of it
+        are being read at the same time; it holds one file descriptor. Users
+        `acquire` an archive and `release` it when done; archives nobody holds are
+        kept open in case they're needed again, up to `max_idle` of them, and the
+        least recently used are closed beyond that. So the number of open
+        descriptors stays constant, however many pages or archives we go through.
+
+        @param max_idle: how many archives to keep open while nobody's using them
+    """
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.archives = {} # path -> ZipArchive, in use or idle
+        self.refs = {} # path -> how many users hold it
+        self.idle = OrderedDict() # paths nobody holds, least recently released first
+        self.opening = set() # paths being opened right now
+        self.lock = threading.Lock()
+        self.opened = threading.Condition(self.lock)
+
+    def acquire(self, path):
+        """ The archive at path, opened if needed. Must be given back with `release`
+            @raises ArchiveError: if it can't be opened
+        """
+        with self.lock:
+            while True:
+                if self._hold(path): return self.archives[path]
+                if path not in self.opening: break
+                self.opened.wait() # someone else is opening it; don't open it twice
+            self.opening.add(path)
+        archive = None
+        try:
+            archive = ZipArchive(path) # slow; don't make everyone else wait
+        finally:
+            with self.lock:
+                self.opening.discard(path)
+                if archive is not None:
+                    self.archives[path] = archive
+                    self.refs[path] = 1
+                self.opened.notify_all()
+        return archive
+
+    def _hold(self, path):
+        if not self.archives.has_key(path): return False
+        self.refs[path] += 1
+        self.idle.pop(path, None)
+        return True
+
+    def release(self, archive):
+        with self.lock:
+            path = archive.path
+            self.refs[path] -= 1
+            if self.refs[path] == 0:
+                self.idle[path] = True
+                self._trim()
+
+    def _trim(self):
+        while len(self.idle) > self.max_idle:
+            path, _ = self.idle.popitem(last=False)
+            self.archives.pop(path).close()
+            del self.refs[path]
+
+    def clear(self):
+        """Close all the archives nobody's using"""
+        with self.lock:
+            max_idle, self.max_idle = self.max_idle, 0
+            self._trim()
+            self.max_idle = max_idle
+
+    @contextmanager
+    def using(self, path):
+        """ with pool.using(path) as archive: ... """
+        archive = self.acquire(path)
+        try:
+            yield archive
+        finally:
+            self.release(archive)
+
+pool = ArchivePool()
+using = pool.using
+
+def read_file(path):
+    """The contents of the file at path, which can be inside an archive"""
+    located = split_path(path)
+    if located is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    archive_path, member = located
+    with using(archive_path) as archive:
+        return archive.read(member)
+
+def open_file(path):
+    """Open the file at path for reading; it can be inside an archive, which is
+       held open until the file is closed
+    """
+    located = split_path(path)
+    if located is None:
+        return open(path, 'rb')
+    archive_path, member = located
+    archive = pool.acquire(archive_path)
+    try:
+        f = archive.open(member)
+    except:
+        pool.release(archive)
+        raise
+    f.on_close = lambda: pool.release(archive)
+    return f
@@ -0,0 +1,167 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for reading pages out of zip archives
+"""
+
+import unittest, os, shutil, tempfile, threading, zipfile
+from mangareader import archive, imgsize, fetch
+from mangareader.tree.walk import step
+from mangareader.imgsizetests import png_header, jpeg_header
+
+def make_zip(path, members, compression=zipfile.ZIP_DEFLATED):
+    """@param members: list of (name, data); names ending with '/' are directories"""
+    z = zipfile.ZipFile(path, 'w', compression)
+    for name, data in members:
+        z.writestr(name, data)
+    z.close()
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'chapter.cbz')
+        self.big = png_header(640, 960) + 'x' * 100000
+        make_zip(self.path, [
+            ('01.png', self.big),
+            ('extras/', ''),
+            ('extras/cover.jpg', jpeg_header(300, 400)),
+            ('bonus/02.png', png_header(10, 20)), # no entry for the directory itself
+            ('__MACOSX/._01.png', 'junk'),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_listing(self):
+        z = archive.ZipArchive(self.path)
+        self.assertEqual(sorted(z.listing()), [('01.png', False), ('bonus', True), ('extras', True)])
+        self.assertEqual(z.listing('extras'), [('cover.jpg', False)])
+        self.assertEqual(z.listing('bonus'), [('02.png', False)])
+        z.close()
+
+    def test_read(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            make_zip(self.path, [('01.png', self.big)], compression)
+            z = archive.ZipArchive(self.path)
+            self.assertEqual(z.read('01.png'), self.big)
+            f = z.open('01.png')
+            self.assertEqual(f.read(8), self.big[:8])
+            f.seek(100, 1)
+            self.assertEqual(f.tell(), 108)
+            self.assertEqual(f.read(), self.big[108:])
+            self.assertRaises(archive.ArchiveError, z.read, 'missing.png')
+            z.close()
+
+    def test_split_path(self):
+        self.assertEqual(archive.split_path(os.path.join(self.path, 'extras', 'cover.jpg')),
+                (self.path, 'extras/cover.jpg'))
+        self.assertEqual(archive.split_path(self.path), None)
+        self.assertEqual(archive.split_path(os.path.join(self.tmp, 'page.png')), None)
+
+    def test_image_size(self):
+        page = os.path.join(self.path, 'extras', 'cover.jpg')
+        self.assertEqual(imgsize.image_size(page), (300, 400))
+        self.assertEqual(imgsize.image_size(os.path.join(self.path, '01.png')), (640, 960))
+
+    def test_utf8_names(self):
+        directory = os.path.join(self.tmp, 'mang\xc3\xa1')
+        os.makedirs(directory)
+        path = os.path.join(directory, 'cap\xc3\xadtulo 1.cbz')
+        data = png_header(30, 40)
+        make_zip(path, [(u'extras/cap\xedtulo/p\xe1gina 01.png', data)]) # stored with the utf-8 flag
+        self.assertTrue(zipfile.ZipFile(path).infolist()[0].flag_bits & 0x800)
+        z = archive.ZipArchive(path)
+        self.assertEqual(z.listing('extras'), [('cap\xc3\xadtulo', True)])
+        self.assertEqual(z.listing('extras/cap\xc3\xadtulo'), [('p\xc3\xa1gina 01.png', False)])
+        z.close()
+        page = os.path.join(path, 'extras', 'cap\xc3\xadtulo', 'p\xc3\xa1gina 01.png')
+        self.assertEqual(archive.read_file(page), data)
+
+        tree = fetch.DirTree(directory)
+        node = step(tree, tree.root)
+        self.assertEqual(node.path, page)
+        self.assertTrue(isinstance(node.path, str))
+        self.assertTrue(tree.get_node('cap\xc3\xadtulo 1.cbz/extras/cap\xc3\xadtulo/p\xc3\xa1gina 01.png') is node)
+
+    def test_broken(self):
+        path = os.path.join(self.tmp, 'broken.cbz')
+        open(path, 'wb').write('not a zip file')
+        self.assertRaises(archive.ArchiveError, archive.ZipArchive, path)
+        open(path, 'wb').close()
+        self.assertRaises(archive.ArchiveError, archive.ZipArchive, path)
+
+def open_descriptors():
+    return len(os.listdir('/proc/self/fd'))
+
+class TestArchivePool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(5):
+            path = os.path.join(self.tmp, 'ch%d.cbz' % i)
+            make_zip(path, [('%03d.png' % p, png_header(10, 20 + p)) for p in range(500 if i == 0 else 3)],
+                    zipfile.ZIP_STORED)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shared(self):
+        pool = archive.ArchivePool()
+        a = pool.acquire(self.paths[0])
+        b = pool.acquire(self.paths[0])
+        self.assertTrue(a is b)
+        self.assertEqual(pool.refs[self.paths[0]], 2)
+        pool.release(a)
+        pool.release(b)
+        self.assertEqual(list(pool.idle), [self.paths[0]])
+        with pool.using(self.paths[0]) as c:
+            self.assertTrue(c is a) # still open
+        pool.clear()
+        self.assertEqual(pool.archives, {})
+
+    def test_idle_ones_get_closed(self):
+        pool = archive.ArchivePool(max_idle=2)
+        held = pool.acquire(self.paths[0])
+        for path in self.paths[1:]:
+            with pool.using(path):
+                pass
+        self.assertEqual(sorted(pool.archives), [self.paths[0]] + self.paths[3:]) # held, and the 2 most recent
+        pool.release(held) # now it's the most recently used
+        self.assertEqual(sorted(pool.archives), [self.paths[0], self.paths[4]])
+
+    def test_zero_copy(self):
+        with archive.using(self.paths[0]) as z:
+            data = z.read_buffer('000.png')
+            self.assertTrue(isinstance(data, buffer))
+            self.assertEqual(data[:8], png_header(10, 20)[:8])
+
+    def test_open_file_holds_archive(self):
+        path = os.path.join(self.paths[1], '001.png')
+        f = archive.open_file(path)
+        self.assertEqual(archive.pool.refs[self.paths[1]], 1)
+        f.close()
+        self.assertEqual(archive.pool.refs[self.paths[1]], 0)
+
+    def test_constant_descriptors(self):
+        if not os.path.isdir('/proc/self/fd'): return # linux only
+        archive.pool.clear()
+        before = open_descriptors()
+        most = [before]
+        counting = threading.Lock() # listing /proc/self/fd takes a descriptor too; one at a time
+        names = ['%03d.png' % p for p in range(500)]
+        def reader(names):
+            for name in names:
+                page = os.path.join(self.paths[0], name)
+                with archive.open_file(page) as f:
+                    f.read(24)
+                with counting:
+                    most.append(open_descriptors())
+        threads = [threading.Thread(target=reader, args=(names[i::4],)) for i in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertTrue(max(most) <= before + 2, (before, max(most))) # the archive (+ its file while opening)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Benchmarks for the parts of the reader that need to stay fast.
+
+    Each benchmark builds a synthetic manga in a temp directory, so they can run anywhere:
+
+        python -m mangareader.benchmarks            # run all of them
+        python -m mangareader.benchmarks listing    # run some of them
+"""
+
+import os, sys, time, shutil, tempfile, threading, zipfile
+
+from mangareader import fetch, archive
+from mangareader.tree import walk
+
+class SyscallCounter(object):
+    """ Count calls to the os functions that hit the disk, by wrapping them.
+
+        os.path.isdir and friends go through os.stat, so they're counted too. What we
+        can't see is the stat that scandir does internally for entries without a d_type
+    """
+    names = ('stat', 'lstat', 'listdir')
+    def __init__(self):
+        self.counts = dict((name, 0) for name in self.names + ('scandir',))
+
+    def _wrap(self, name, func):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        self.originals = dict((name, getattr(os, name)) for name in self.names)
+        for name, func in self.originals.items():
+            setattr(os, name, self._wrap(name, func))
+        self.original_scandir = fetch.scandir
+        if fetch.scandir is not None:
+            fetch.scandir = self._wrap('scandir', fetch.scandir)
+        return self
+
+    def __exit__(self, *exc):
+        for name, func in self.originals.items():
+            setattr(os, name, func)
+        fetch.scandir = self.original_scandir
+
+    def total(self):
+        return sum(self.counts.values())
+
+def make_synthetic_tree(root, chapters=20, pages=200):
+    """A manga with `chapters` directories of `pages` (empty) images, plus some junk files"""
+    for c in range(chapters):
+        chapter = os.path.join(root, 'chapter %03d' % c)
+        os.makedirs(chapter)
+        for p in range(pages):
+            open(os.path.join(chapter, 'page %04d.jpg' % p), 'wb').close()
+        open(os.path.join(chapter, 'credits.txt'), 'wb').close()
+
+def with_temp_dir(func):
+    def wrapper(*args):
+        tmp = tempfile.mkdtemp(prefix='mangareader-bench-')
+        try:
+            return func(tmp, *args)
+        finally:
+            shutil.rmtree(tmp)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def baseline_dir_node_list(directory):
+    """How directories used to be listed: listdir, then realpath and stat every entry"""
+    listing = [fetch.DirNode(os.path.join(directory, name)) for name in sorted(os.listdir(directory))]
+    return [item for item in listing if item.isdir or fetch.is_image(item.path)]
+
+def list_whole_tree(root, list_func):
+    directories = [root]
+    count = 0
+    while directories:
+        directory = directories.pop()
+        for node in list_func(directory):
+            count += 1
+            if node.isdir:
+                directories.append(node.path)
+    return count
+
+@with_temp_dir
+def bench_listing(tmp, chapters=20, pages=200):
+    """Syscalls needed to list a whole manga"""
+    root = os.path.realpath(tmp)
+    make_synthetic_tree(root, chapters, pages)
+    print "listing %d chapters x %d pages" % (chapters, pages)
+    print "%-28s %8s %8s %8s %8s %8s %10s" % ('', 'listdir', 'scandir', 'stat', 'lstat', 'total', 'time (ms)')
+    variants = [('before (listdir + stats)', baseline_dir_node_list, None)]
+    variants.append(('after, no scandir', fetch.dir_node_list, False))
+    if fetch.scandir is not None:
+        variants.append(('after, scandir d_type', fetch.dir_node_list, True))
+    else:
+        print "(scandir is not available; install the scandir backport to compare)"
+    for label, list_func, use_scandir in variants:
+        original_scandir = fetch.scandir
+        if use_scandir is False:
+            fetch.scandir = None
+        try:
+            with SyscallCounter() as counter:
+                start = time.time()
+                nodes = list_whole_tree(root, list_func)
+                elapsed = time.time() - start
+        finally:
+            fetch.scandir = original_scandir
+        c = counter.counts
+        print "%-28s %8d %8d %8d %8d %8d %10.1f" % (label, c['listdir'], c['scandir'],
+                c['stat'], c['lstat'], counter.total(), elapsed * 1000)
+    print "(%d nodes)" % nodes
+
+def baseline_node_sibling(parent, node, offset):
+    """How siblings used to be found: by searching the parent's list"""
+    index = parent.ls.index(node)
+    sibdex = index + offset
+    if 0 <= sibdex < len(parent.ls):
+        return parent.ls[sibdex]
+    else:
+        return None
+
+def walk_forward(tree):
+    count = 0
+    node = walk.step(tree, tree.root)
+    while node is not None:
+        count += 1
+        node = walk.step(tree, node)
+    return count
+
+@with_temp_dir
+def bench_walk(tmp, pages=5000):
+    """Stepping through a big flat directory, one page at a time"""
+    root = os.path.realpath(tmp)
+    for p in range(pages):
+        open(os.path.join(root, 'page %05d.jpg' % p), 'wb').close()
+    print "walking a flat directory of %d pages" % pages
+    tree = fetch.DirTree(root)
+    tree.root.ls # list it up front; we're only timing the walk
+    for label, sibling_func in (('before (list.index)', baseline_node_sibling),
+                                ('after (node position)', walk.node_sibling)):
+        original = walk.node_sibling
+        walk.node_sibling = sibling_func
+        try:
+            start = time.time()
+            steps = walk_forward(tree)
+            elapsed = time.time() - start
+        finally:
+            walk.node_sibling = original
+        print "%-24s %6d steps %10.1f ms %8.2f us/step" % (label, steps, elapsed * 1000, 
+                elapsed * 1e6 / steps)
+
+def baseline_read_member(path, member):
+    """How an archive member would be read without the pool: open the zip every time"""
+    z = zipfile.ZipFile(path)
+    try:
+        return z.read(member)
+    finally:
+        z.close()
+
+def pooled_read_member(path, member):
+    with archive.using(path) as z:
+        return len(z.read_buffer(member)) # stored members come without a copy
+
+def open_descriptors():
+    if not os.path.isdir('/proc/self/fd'): return 0
+    return len(os.listdir('/proc/self/fd'))
+
+@with_temp_dir
+def bench_archive(tmp, pages=500, workers=4, page_size=200 * 1024):
+    """Reading every page of a (stored) cbz from several threads"""
+    path = os.path.join(tmp, 'chapter.cbz')
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+    data = os.urandom(page_size)
+    for p in range(pages):
+        z.writestr('%03d.jpg' % p, data)
+    z.close()
+    names = ['%03d.jpg' % p for p in range(pages)]
+    print "reading %d pages of %d KB with %d threads" % (pages, page_size // 1024, workers)
+    for label, read in (('before (open per page)', baseline_read_member), 
+                        ('after (shared mmap)', pooled_read_member)):
+        archive.pool.clear()
+        before = open_descriptors()
+        most = [before]
+        def reader(names):
+            for name in names:
+                read(path, name)
+                most.append(open_descriptors())
+        threads = [threading.Thread(target=reader, args=(names[i::workers],)) for i in range(workers)]
+        start = time.time()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        elapsed = time.time() - start
+        print "%-24s %10.1f ms   most descriptors open: %d (+%d)" % (label, elapsed * 1000, 
+                max(most), max(most) - before)
+    archive.pool.clear()
+
+benchmarks = dict(
+    listing = bench_listing,
+    walk = bench_walk,
+    archive = bench_archive,
+)
+
+def main(names):
+    for name in names or sorted(benchmarks.keys()):
+        print "==== %s ====" % name
+        benchmarks[name]()
+        print
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
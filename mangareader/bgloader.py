@@ -2,50 +2,214 @@
     Author: Hasen il Judy
     License: GPLv2
 
-    Loads image files in a background thread
+    Loads image files in background threads
 
     Actually, this module provides a facility to queue a list of functions to be performed
-    by some specific (named) thread. Right now though, we only use one thread: the image loading thread
+    by some specific (named) pool of worker threads. Right now we use two pools: the image
+    loading pool, and the directory lister that prefetches the next chapter
+
+    Workers sleep on a condition variable, so a queued function starts running as soon
+    as a worker is free, instead of waiting for the next polling tick.
+
+    Functions can be queued with a priority (lower runs first) and a tag. Pending functions
+    can later be re-prioritized or cancelled by their tag; this is how the image loader
+    keeps decoding the pages closest to the reader first.
+
+    Decoding itself is mostly python-free, but the GIL still gets in the way when lots
+    of pictures are decoded at once. So each kind of job (named like its thread) can
+    pick a decode backend: 'thread' decodes in the worker thread itself, 'process'
+    sends the work to a pool of processes (the worker thread just waits for the
+    result). Page loads are the only decoding job so far, and they stay on threads
+    unless configured otherwise. The process backend needs shared memory (see the
+    sharedmem module), so it's posix only.
 
 '''
-import thread, time
+import thread, threading, traceback, heapq, itertools
+
+from mangareader import sharedmem
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
 class RunnerQueue(object):
-    """A thread that queues functions for running. functions must be short/not take a long time"""
-    def __init__(self, name):
+    """A pool of threads that queues functions for running. functions must be short/not take a long time
+
+        @param workers: how many threads pull functions from the queue
+        @param maxsize: max number of pending functions; `push` blocks while the
+            queue is full. 0 means unbounded
+    """
+    def __init__(self, name, workers=1, maxsize=0):
         self.name = name
-        self.list = []
+        self.maxsize = maxsize
+        self.list = [] # a heap of [priority, seq, target, tag, on_cancel]
+        self.counter = itertools.count() # keeps equal priorities in FIFO order
         self.list_lock = thread.allocate_lock()
-        self.thread = thread.start_new_thread(self.run, ())
-    def push(self, target):
+        self.not_empty = threading.Condition(self.list_lock)
+        self.not_full = threading.Condition(self.list_lock)
+        self.threads = [thread.start_new_thread(self.run, ()) for i in range(max(1, workers))]
+    def push(self, target, priority=0, tag=None, on_cancel=None):
+        """
+            @param priority: lower values run first
+            @param tag: optional key used by `reprioritize` and `cancel`
+            @param on_cancel: optional function to call if the target gets dropped without running
+        """
         with self.list_lock:
-            self.list.append(target)
+            while self.maxsize and len(self.list) >= self.maxsize:
+                self.not_full.wait()
+            heapq.heappush(self.list, [priority, self.counter.next(), target, tag, on_cancel])
+            self.not_empty.notify()
+    def reprioritize(self, key):
+        """
+            Recompute the priority of every tagged pending function.
+
+            @param key: function(tag) -> new priority, or None to drop the function
+        """
+        dropped = []
+        with self.list_lock:
+            kept = []
+            for entry in self.list:
+                if entry[3] is not None:
+                    priority = key(entry[3])
+                    if priority is None:
+                        dropped.append(entry)
+                        continue
+                    entry[0] = priority
+                kept.append(entry)
+            heapq.heapify(kept)
+            self.list = kept
+            if dropped: self.not_full.notify_all()
+        self._notify_cancelled(dropped)
+    def cancel(self, tags):
+        """Drop pending functions whose tag is in `tags`"""
+        tags = set(tags)
+        if not tags: return
+        with self.list_lock:
+            dropped = [entry for entry in self.list if entry[3] in tags]
+            if not dropped: return
+            self.list = [entry for entry in self.list if entry[3] not in tags]
+            heapq.heapify(self.list)
+            self.not_full.notify_all()
+        self._notify_cancelled(dropped)
+    def _notify_cancelled(self, entries):
+        for entry in entries:
+            if entry[4] is not None:
+                entry[4]()
+    def pending(self):
+        """How many functions are waiting for a worker"""
+        with self.list_lock:
+            return len(self.list)
     def run(self):
         """
-            This function runs in its own thread!
+            This function runs in its own thread! (one per worker)
         """
         while True:
-            while len(self.list) == 0:
-                time.sleep(0.2) # number is in seconds
             with self.list_lock:
-                target = self.list.pop(0)
-            target()
+                while not self.list:
+                    self.not_empty.wait()
+                target = heapq.heappop(self.list)[2]
+                self.not_full.notify()
+            try:
+                target()
+            except Exception:
+                # don't let one bad image kill the worker
+                traceback.print_exc()
+
+# per-thread options, looked up when the named thread is first used
+thread_options = {
+    "image_loader": dict(workers=cpu_count(), maxsize=256),
+    "directory_lister": dict(workers=1), # reads ahead into the next chapter
+}
 
 threads = {}
-def queue_function_in_thread(target, name):
+threads_lock = thread.allocate_lock()
+
+def set_thread_options(name, workers=1, maxsize=0):
+    """
+        Configure the named thread pool. Only has effect if called before the
+        first function is queued in that thread.
+    """
+    thread_options[name] = dict(workers=workers, maxsize=maxsize)
+
+def get_runner(name):
+    with threads_lock:
+        if not threads.has_key(name):
+            threads[name] = RunnerQueue(name, **thread_options.get(name, {}))
+        return threads[name]
+
+def queue_function_in_thread(target, name, priority=0, tag=None, on_cancel=None):
     """
         Put a function in the queue of a named thread.
-        Right now we only use the image_loader thread, 
+        Right now we use the image_loader and directory_lister threads,
         but it sounds useful to generalize it a bit since it doesn't cost much at all
 
         @param target: function to run inside thread
-        @param name: the name of the thread 
+        @param name: the name of the thread
+        @param priority, tag, on_cancel: see RunnerQueue.push
+    """
+    get_runner(name).push(target, priority, tag, on_cancel)
+
+
+# decode backend of each kind of job: 'thread' or 'process'
+job_backends = {
+    "image_loader": "thread",
+}
+
+process_pools = {}
+
+def set_job_backend(name, backend):
+    """
+        Choose how the named kind of job decodes.
+
+        @param backend: 'thread' or 'process'
     """
-    if not threads.has_key(name):
-        threads[name] = RunnerQueue(name)
-    threads[name].push(target)
+    if backend not in ('thread', 'process'):
+        raise ValueError("unknown decode backend: %s" % backend)
+    if backend == 'process' and not sharedmem.available():
+        raise ValueError("decoding in processes needs shared memory (/dev/shm)")
+    job_backends[name] = backend
+
+def job_backend(name):
+    return job_backends.get(name, "thread")
+
+def get_process_pool(name):
+    """
+        The process pool of the named kind of job, started on first use with as
+        many processes as the named thread has workers.
+
+        Processes are forked, so it's best to start the pool early, before other
+        threads (or Qt) have a chance to hold locks the children would inherit.
+    """
+    with threads_lock:
+        if not process_pools.has_key(name):
+            import multiprocessing
+            workers = thread_options.get(name, {}).get('workers', cpu_count())
+            process_pools[name] = multiprocessing.Pool(max(1, workers))
+        return process_pools[name]
+
+def run_in_process(name, function, *args):
+    """
+        Run function(*args) in the named process pool, and wait for its result.
+        Meant to be called from a worker thread; function, args and the result
+        must be picklable (so function must be defined at module level)
+    """
+    return get_process_pool(name).apply(function, args)
+
+def stop_process_pools():
+    with threads_lock:
+        for pool in process_pools.values():
+            pool.terminate()
+        process_pools.clear()
 
+def queue_image_loader(loader, priority=0, tag=None, on_cancel=None):
+    queue_function_in_thread(loader, "image_loader", priority, tag, on_cancel)
 
-def queue_image_loader(loader):
-    queue_function_in_thread(loader, "image_loader")
+def reprioritize_image_loaders(key):
+    get_runner("image_loader").reprioritize(key)
 
+def cancel_image_loaders(tags):
+    get_runner("image_loader").cancel(tags)
 
@@ -0,0 +1,109 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for the background function queue
+"""
+
+import unittest, threading, os
+from mangareader import bgloader, sharedmem
+from mangareader.bgloader import RunnerQueue
+
+class TestRunnerQueue(unittest.TestCase):
+    def test_runs_everything(self):
+        queue = RunnerQueue("test", workers=3, maxsize=2)
+        done = []
+        finished = threading.Event()
+        def make_job(i):
+            def job():
+                done.append(i)
+                if len(done) == 20: finished.set()
+            return job
+        for i in range(20):
+            queue.push(make_job(i))
+        finished.wait(5)
+        self.assertEqual(sorted(done), range(20))
+
+    def test_survives_failing_job(self):
+        queue = RunnerQueue("test-fail", workers=1)
+        finished = threading.Event()
+        def bad(): raise ValueError("broken image")
+        import sys, StringIO
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO() # keep the traceback quiet
+        try:
+            queue.push(bad)
+            queue.push(finished.set)
+            finished.wait(5)
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(finished.is_set())
+
+class TestPriorities(unittest.TestCase):
+    def setUp(self):
+        # a single worker, held busy until we're done queueing
+        self.queue = RunnerQueue("test-priority", workers=1)
+        self.gate = threading.Event()
+        self.queue.push(self.gate.wait)
+        self.done = []
+        self.finished = threading.Event()
+
+    def push(self, name, priority):
+        self.queue.push(lambda: self.done.append(name), priority, tag=name,
+                on_cancel=lambda: self.done.append("cancelled " + name))
+
+    def run_queue(self):
+        self.queue.push(self.finished.set, priority=1000)
+        self.gate.set()
+        self.finished.wait(5)
+
+    def test_priority_order(self):
+        for name, priority in (('a', 3), ('b', 1), ('c', 2), ('d', 1)):
+            self.push(name, priority)
+        self.run_queue()
+        self.assertEqual(self.done, ['b', 'd', 'c', 'a'])
+
+    def test_reprioritize_and_cancel(self):
+        for name, priority in (('a', 1), ('b', 2), ('c', 3), ('d', 4)):
+            self.push(name, priority)
+        new_priorities = dict(a=5, b=None, c=1, d=2)
+        self.queue.reprioritize(lambda tag: new_priorities[tag])
+        self.queue.cancel(['d'])
+        self.run_queue()
+        self.assertEqual(self.done, ['cancelled b', 'cancelled d', 'c', 'a'])
+
+def make_pixels(size):
+    """a process job: 'decode' a picture into shared memory"""
+    return sharedmem.export(''.join(chr(i % 256) for i in range(size))), os.getpid()
+
+class TestProcessBackend(unittest.TestCase):
+    def setUp(self):
+        self.old_backends = dict(bgloader.job_backends)
+
+    def tearDown(self):
+        bgloader.job_backends.clear()
+        bgloader.job_backends.update(self.old_backends)
+        bgloader.stop_process_pools()
+
+    def test_backend_per_job_type(self):
+        if not sharedmem.available(): return # posix only
+        self.assertEqual(bgloader.job_backend("image_loader"), "thread")
+        bgloader.set_job_backend("test-batch", "process")
+        self.assertEqual(bgloader.job_backend("test-batch"), "process")
+        self.assertEqual(bgloader.job_backend("image_loader"), "thread")
+        self.assertRaises(ValueError, bgloader.set_job_backend, "image_loader", "gpu")
+
+    def test_pixels_through_shared_memory(self):
+        if not sharedmem.available(): return # posix only
+        bgloader.set_thread_options("test-process", workers=2)
+        name, pid = bgloader.run_in_process("test-process", make_pixels, 100000)
+        self.assertNotEqual(pid, os.getpid())
+        pixels = sharedmem.attach(name)
+        self.assertFalse(os.path.exists(name)) # nothing left behind
+        self.assertEqual(len(pixels), 100000)
+        self.assertEqual(pixels[:3], '\x00\x01\x02')
+        self.assertEqual(pixels[256:258], '\x00\x01')
+        pixels[0] = 'x' # private: ours to write on
+        pixels.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,11 +14,23 @@
             node: means the DirNode object
 """
 
-import os
+import os, threading
 from time import time as now
-from mangareader.tree.walk import step as walk_step
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # the backport, for older pythons
+    except ImportError:
+        scandir = None
+from mangareader.tree.walk import step as walk_step, sibling_next, sibling_prev
+from mangareader.pageindex import PageIndex
+from mangareader import archive
+from mangareader.bgloader import queue_function_in_thread
 
 
+FORWARD, BACKWARD = 1, -1
+
 # ------ some primitives ----------------
 
 def real_path(root):
@@ -32,21 +44,70 @@ def is_image(filepath):
     _, ext = os.path.splitext(filepath)
     return ext.lower() in ('.png', '.jpg', '.jpeg', '.gif')
         
-def dir_node_list(directory, sort_func=default_sort, filterer=is_image):
-    directory = real_path(directory)
-    listing = [DirNode(os.path.join(directory, name))
-            for name in sort_func(os.listdir(directory))] 
-    listing = [item for item in listing if item.isdir or filterer(item.path)]
-    return listing
+def list_entries(directory):
+    """List directory, telling which entries are directories
+
+        With scandir, the type comes from the directory read itself (d_type), so there's
+        no stat per entry; scandir only stats entries whose type the filesystem doesn't
+        report (or that are symlinks). Without scandir, we stat every entry.
+
+        @returns: a list of (name, isdir)
+    """
+    if scandir is None:
+        return [(name, os.path.isdir(os.path.join(directory, name))) for name in os.listdir(directory)]
+    return [(entry.name, entry.is_dir()) for entry in scandir(directory)]
+
+def dir_node_list(directory, sort_func=default_sort, filterer=is_image, page_index=None):
+    """List the nodes inside directory
+
+        @param directory: the path of a directory node (entries are joined to it as is)
+        @param page_index: optional PageIndex; if it has an up-to-date listing, we use it 
+            instead of hitting the disk for every entry
+    """
+    if page_index is not None:
+        entries = page_index.listing(directory)
+        if entries is not None:
+            return [make_node(os.path.join(directory, name), isdir, page_index) for name, isdir in entries]
+        mtime = os.stat(directory).st_mtime # before listing, so changes made meanwhile invalidate it
+    types = dict(list_entries(directory))
+    names = [name for name in sort_func(types.keys()) 
+            if types[name] or filterer(os.path.join(directory, name)) or archive.is_archive(name)]
+    if page_index is not None:
+        page_index.record_listing(directory, [(name, types[name]) for name in names], mtime)
+    return [make_node(os.path.join(directory, name), types[name], page_index) for name in names]
+
+def make_node(path, isdir, page_index=None):
+    """The node for a directory entry; archives get a ZipNode, which acts as a directory"""
+    if not isdir and archive.is_archive(path):
+        return ZipNode(path)
+    return DirNode(path, isdir=isdir, resolve=False, page_index=page_index)
+
+# listings are made outside the lock, and published under it, so a node is 
+# listed once even if the prefetcher and the GUI thread race for it
+_publish_lock = threading.Lock()
+
+# how deep to follow first children when prefetching (e.g. volume/chapter/pages)
+PREFETCH_DEPTH = 3
 
 class DirNode(object):
-    def __init__(self, path):
-        path = real_path(path)
+    """
+        @param isdir: optional, if we already know whether it's a directory
+        @param resolve: resolve symlinks in path; only needed for the root, children
+            of a node are joined to its path
+        @param page_index: optional PageIndex to use when listing this node
+    """
+    def __init__(self, path, isdir=None, resolve=True, page_index=None):
+        if resolve:
+            path = real_path(path)
         self.path = path
         self.name = os.path.basename(path)
-        self._isdir = None
+        self.page_index = page_index
+        self.parent = None   # set when our parent lists us
+        self.position = None # our index in parent.ls
+        self._isdir = isdir
         self._ls = None
         self._ls_map = None
+        self._prefetching = False
 
     @property
     def isdir(self): 
@@ -61,9 +122,41 @@ class DirNode(object):
     @property
     def ls(self):
         if self.isdir and self._ls is None: # lazy, ditto
-            self._ls = dir_node_list(self.path, filterer=is_image)
+            self._set_listing(self._list())
         return self._ls
 
+    def _list(self):
+        return dir_node_list(self.path, filterer=is_image, page_index=self.page_index)
+
+    def _set_listing(self, listing):
+        """Publish listing as our children, unless someone else beat us to it"""
+        for position, item in enumerate(listing):
+            item.parent = self
+            item.position = position
+        with _publish_lock:
+            if self._ls is None:
+                self._ls = listing
+
+    def prefetch(self, direction=FORWARD, depth=PREFETCH_DEPTH):
+        """ List this directory in the background, so stepping into it later doesn't
+            hit the disk on the GUI thread. If the child we'd step into first (per
+            direction) is a directory, it gets listed too, `depth` levels down.
+        """
+        if self._ls is not None or self._prefetching or not self.isdir: return
+        self._prefetching = True
+        def lister(): # this will run in a background thread
+            try:
+                self._set_listing(self._list())
+            except OSError: 
+                return # gone, or not readable; the GUI thread will find out when it gets here
+            finally:
+                self._prefetching = False
+            if self._ls and depth > 1:
+                first = self._ls[0] if direction == FORWARD else self._ls[-1]
+                if first.isdir:
+                    first.prefetch(direction, depth - 1)
+        queue_function_in_thread(lister, "directory_lister")
+
     @property
     def ls_map(self):
         if self._ls_map is None: 
@@ -86,7 +179,31 @@ class DirNode(object):
         type = "dir " if self.isdir else "file"
         return "[%s] %s" % (type, self.name) 
 
-FORWARD, BACKWARD = 1, -1
+class ZipNode(DirNode):
+    """ A node inside a zip (cbz) archive, or the archive itself, which acts as a directory.
+
+        The listing comes from the archive's central directory, which is read once
+        for the whole archive; pages are read from the archive by their path (see
+        the archive module)
+
+        @param member: the '/' separated name inside the archive; '' for the archive itself
+    """
+    def __init__(self, archive_path, member='', isdir=True):
+        DirNode.__init__(self, archive.member_path(archive_path, member), isdir=isdir, resolve=False)
+        self.archive_path = archive_path
+        self.member = member
+
+    def _list(self):
+        try:
+            with archive.using(self.archive_path) as z:
+                entries = z.listing(self.member)
+        except archive.ArchiveError, e:
+            print "Warning:", e
+            return [] # treat a broken archive like an empty directory
+        types = dict(entries)
+        prefix = self.member + '/' if self.member else ''
+        return [ZipNode(self.archive_path, prefix + name, types[name]) 
+                for name in default_sort(types.keys()) if types[name] or is_image(name)]
 
 class NotSubdirectoryError(Exception): pass
 
@@ -96,12 +213,26 @@ class InvalidEntryName(Exception):
 
 class DirTree(object):
     """The directory tree is used for the root directory of the manga"""
-    def __init__(self, root_path):
-        """@param root_path: the directory we walk inside"""
+    def __init__(self, root_path, indexed=False):
+        """@param root_path: the directory we walk inside
+           @param indexed: keep a persistent PageIndex of the tree, so next time we open it
+               we don't have to list every directory and read every image header again
+        """
         self.root_path = real_path(root_path)
-        self.root = DirNode(self.root_path)
+        self.page_index = None
+        if indexed:
+            self.page_index = PageIndex(self.root_path)
+        if archive.is_archive(self.root_path) and os.path.isfile(self.root_path):
+            self.root = ZipNode(self.root_path) # a single archive
+        else:
+            self.root = DirNode(self.root_path, page_index=self.page_index)
         self.cache = {} # maps paths to entries
 
+    def save_index(self):
+        """Write the page index (if any) to disk"""
+        if self.page_index is not None:
+            self.page_index.save()
+
     def next_item(self, path):
         node = self.get_node(path)
         return walk_step(self, node, 'next')
@@ -127,8 +258,27 @@ class DirTree(object):
         self.cache[path] = node
         return node
 
+    def prefetch_sibling_chapter(self, node, direction=FORWARD):
+        """ Start listing (in the background) the directory the walk will enter after
+            it's done with the directory of `node`; going up the tree as needed.
+
+            @returns: the directory node being prefetched, or None if there's none
+        """
+        get_sibling = sibling_next if direction == FORWARD else sibling_prev
+        directory = self.parent(node)
+        while directory is not None and directory is not self.root:
+            sibling = get_sibling(self, directory)
+            if sibling is not None:
+                if not sibling.isdir: return None # a page; nothing to list
+                sibling.prefetch(direction)
+                return sibling
+            directory = self.parent(directory)
+        return None
+
     def parent(self, node):
         """Get the parent for the given node"""
+        if node.parent is not None:
+            return node.parent
         path = node.path
         path = self.relpath(path)
         parent, name = os.path.split(path)
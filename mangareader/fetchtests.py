@@ -0,0 +1,127 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for listing manga trees: prefetching directory listings in the 
+    background, and walking into archives
+"""
+
+import unittest, os, shutil, tempfile, time, zipfile
+from mangareader import fetch
+from mangareader.tree.walk import step
+from mangareader.archivetests import make_zip
+
+def make_tree(root):
+    """two volumes of two chapters of three pages"""
+    for v in range(2):
+        for c in range(2):
+            chapter = os.path.join(root, 'vol%d' % v, 'ch%d' % c)
+            os.makedirs(chapter)
+            for p in range(3):
+                open(os.path.join(chapter, '%02d.png' % p), 'wb').close()
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline: return False
+        time.sleep(0.01)
+    return True
+
+def listed(node):
+    return lambda: node._ls is not None and not node._prefetching
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        make_tree(self.root)
+        self.tree = fetch.DirTree(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_next_chapter(self):
+        last_page = self.tree.get_node('vol0/ch0/02.png')
+        chapter = self.tree.prefetch_sibling_chapter(last_page)
+        self.assertEqual(chapter.name, 'ch1')
+        self.assertTrue(wait_for(listed(chapter)))
+        listing = chapter._ls
+        self.assertEqual([node.position for node in listing], [0, 1, 2])
+        self.assertTrue(all(node.parent is chapter for node in listing))
+        # the walk picks up the prefetched listing, without listing again
+        self.assertTrue(step(self.tree, last_page) is listing[0])
+        self.assertTrue(chapter.ls is listing)
+
+    def test_next_volume(self):
+        last_page = self.tree.get_node('vol0/ch1/02.png')
+        volume = self.tree.prefetch_sibling_chapter(last_page)
+        self.assertEqual(volume.name, 'vol1')
+        self.assertTrue(wait_for(listed(volume)))
+        first_chapter = volume._ls[0]
+        self.assertTrue(wait_for(listed(first_chapter))) # followed into the first chapter
+        self.assertEqual(step(self.tree, last_page).path,
+                os.path.join(self.tree.root_path, 'vol1', 'ch0', '00.png'))
+
+    def test_previous_chapter(self):
+        first_page = self.tree.get_node('vol1/ch1/00.png')
+        chapter = self.tree.prefetch_sibling_chapter(first_page, fetch.BACKWARD)
+        self.assertEqual(chapter.name, 'ch0')
+        self.assertTrue(wait_for(listed(chapter)))
+
+    def test_end_of_manga(self):
+        last_page = self.tree.get_node('vol1/ch1/02.png')
+        self.assertEqual(self.tree.prefetch_sibling_chapter(last_page), None)
+
+def walk_names(tree, dir='next'):
+    names = []
+    node = step(tree, tree.root, dir)
+    while node is not None:
+        names.append(os.path.relpath(node.path, tree.root_path))
+        node = step(tree, node, dir)
+    return names
+
+class TestArchives(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'manga')
+        os.makedirs(os.path.join(self.root, 'ch2'))
+        open(os.path.join(self.root, 'ch2', '01.png'), 'wb').close()
+        make_zip(os.path.join(self.root, 'ch1.cbz'), [('02.png', ''), ('01.png', ''), ('notes.txt', '')])
+        make_zip(os.path.join(self.root, 'ch3.zip'), [('pages/01.png', ''), ('empty/', '')],
+                zipfile.ZIP_STORED)
+        self.old_cache = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        if self.old_cache is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache
+        shutil.rmtree(self.tmp)
+
+    expected = ['ch1.cbz/01.png', 'ch1.cbz/02.png', 'ch2/01.png', 'ch3.zip/pages/01.png']
+
+    def test_walk(self):
+        tree = fetch.DirTree(self.root)
+        self.assertEqual(walk_names(tree), self.expected)
+        self.assertEqual(walk_names(tree, 'prev'), self.expected[::-1])
+
+    def test_walk_indexed(self):
+        tree = fetch.DirTree(self.root, indexed=True)
+        self.assertEqual(walk_names(tree), self.expected)
+        tree.save_index()
+        tree = fetch.DirTree(self.root, indexed=True) # the listing comes from the index now
+        self.assertEqual(walk_names(tree), self.expected)
+
+    def test_get_node(self):
+        tree = fetch.DirTree(self.root)
+        node = tree.get_node('ch3.zip/pages/01.png')
+        self.assertTrue(node.isfile)
+        self.assertEqual(tree.parent(node).name, 'pages')
+        self.assertEqual(step(tree, node, 'prev').name, '01.png') # ch2/01.png
+
+    def test_archive_as_root(self):
+        tree = fetch.DirTree(os.path.join(self.root, 'ch1.cbz'))
+        self.assertEqual(walk_names(tree), ['01.png', '02.png'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Find out the dimensions of an image by parsing its header only, without decoding it.
+
+    Knowing the size of a page is enough to lay it out (and scroll across it),
+    so we can do that long before the pixels are ready.
+
+    Supports the formats we list in fetch.is_image: png, jpeg and gif
+"""
+
+import struct, threading
+
+from mangareader import archive
+
+class UnknownImageFormat(Exception): pass
+
+def probe_size(fileobj):
+    """Read the (width, height) of the image in fileobj from its header
+
+        @param fileobj: a file-like object positioned at the start of the image
+        @raises UnknownImageFormat: if the header is not png, jpeg or gif (or is broken)
+    """
+    head = fileobj.read(26)
+    if head[:8] == '\x89PNG\r\n\x1a\n' and head[12:16] == 'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in ('GIF87a', 'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head[:2] == '\xff\xd8':
+        fileobj.seek(2)
+        return _probe_jpeg(fileobj)
+    raise UnknownImageFormat()
+
+# start-of-frame markers carry the image size; the rest are tables, metadata, etc
+_jpeg_sof_markers = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+# markers without a length field
+_jpeg_standalone_markers = set(range(0xd0, 0xd9)) | set([0x01])
+
+def _probe_jpeg(fileobj):
+    """Walk the jpeg segments until the start-of-frame"""
+    while True:
+        byte = fileobj.read(1)
+        if not byte: raise UnknownImageFormat("no frame header")
+        if byte != '\xff': continue
+        marker = fileobj.read(1)
+        while marker == '\xff': # fill bytes
+            marker = fileobj.read(1)
+        if not marker: raise UnknownImageFormat("no frame header")
+        marker = ord(marker)
+        if marker in _jpeg_standalone_markers or marker == 0:
+            continue
+        length = fileobj.read(2)
+        if len(length) < 2: raise UnknownImageFormat("truncated segment")
+        length, = struct.unpack('>H', length)
+        if marker in _jpeg_sof_markers:
+            data = fileobj.read(5)
+            if len(data) < 5: raise UnknownImageFormat("truncated frame header")
+            height, width = struct.unpack('>xHH', data)
+            return width, height
+        fileobj.seek(length - 2, 1)
+
+_sizes = {} # maps paths to (width, height), or None if we couldn't tell
+_sizes_lock = threading.Lock()
+
+def image_size(path):
+    """Get the (width, height) of the image at path, or None if the header can't be parsed
+
+        The path can be inside an archive. Results are cached per path
+    """
+    with _sizes_lock:
+        if _sizes.has_key(path):
+            return _sizes[path]
+    try:
+        with archive.open_file(path) as fileobj:
+            size = tuple(probe_size(fileobj))
+    except (IOError, UnknownImageFormat, struct.error):
+        size = None
+    remember_size(path, size)
+    return size
+
+def cached_size(path):
+    """The size of the image at path if we already know it; never touches the disk"""
+    with _sizes_lock:
+        return _sizes.get(path)
+
+def remember_size(path, size):
+    """Put a size we learned some other way (e.g. by decoding) in the cache"""
+    with _sizes_lock:
+        _sizes[path] = size
+
+def forget_size(path):
+    with _sizes_lock:
+        _sizes.pop(path, None)
@@ -0,0 +1,57 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for reading image sizes from headers
+"""
+
+import unittest, struct, os, tempfile
+from StringIO import StringIO
+from mangareader.imgsize import probe_size, image_size, UnknownImageFormat
+
+def png_header(width, height):
+    return '\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + 'IHDR' + struct.pack('>II', width, height) + '\x08\x02\x00\x00\x00'
+
+def gif_header(width, height):
+    return 'GIF89a' + struct.pack('<HH', width, height) + '\x00' * 16
+
+def jpeg_header(width, height, sof=0xc0):
+    app0 = '\xff\xe0' + struct.pack('>H', 16) + 'JFIF\x00' + '\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    dqt = '\xff\xdb' + struct.pack('>H', 5) + '\x00\x01\x02'
+    sof = '\xff' + chr(sof) + struct.pack('>HBHHB', 11, 8, height, width, 1) + '\x01\x11\x00'
+    return '\xff\xd8' + app0 + dqt + '\xff\xff' + sof + '\xff\xda'
+
+class TestProbeSize(unittest.TestCase):
+    def test_png(self):
+        self.assertEqual(probe_size(StringIO(png_header(800, 1200))), (800, 1200))
+
+    def test_gif(self):
+        self.assertEqual(probe_size(StringIO(gif_header(640, 480))), (640, 480))
+
+    def test_jpeg(self):
+        self.assertEqual(probe_size(StringIO(jpeg_header(4000, 6000))), (4000, 6000))
+
+    def test_progressive_jpeg(self):
+        self.assertEqual(probe_size(StringIO(jpeg_header(900, 1300, sof=0xc2))), (900, 1300))
+
+    def test_unknown(self):
+        self.assertRaises(UnknownImageFormat, probe_size, StringIO('BM' + '\x00' * 40))
+        self.assertRaises(UnknownImageFormat, probe_size, StringIO('\xff\xd8\xff\xe0\x00'))
+
+class TestImageSizeCache(unittest.TestCase):
+    def test_file(self):
+        fd, path = tempfile.mkstemp(suffix='.png')
+        try:
+            os.write(fd, png_header(10, 20))
+            os.close(fd)
+            self.assertEqual(image_size(path), (10, 20))
+            os.remove(path)
+            self.assertEqual(image_size(path), (10, 20)) # cached, no need to hit the disk
+        finally:
+            if os.path.exists(path): os.remove(path)
+
+    def test_missing_file(self):
+        self.assertEqual(image_size('/no/such/file.png'), None)
+
+if __name__ == '__main__':
+    unittest.main()
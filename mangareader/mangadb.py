@@ -2,12 +2,9 @@
     Author: Hasen "hasenj" il Judy
     License: GPL v2
 
-    We keep a list of known mangas, and a few attributes about each of them. 
-    We don't use a relational database system (they all suck).
+    We keep a list of known mangas, and a few attributes about each of them.
 
-    We use a config file, powered by `configobj`
-
-    The format is really simple: (pseudo config object)
+    Each manga is a record, pretty much a dict: (pseudo config object)
 
         manga_name:
             name: Humanized Manga Name
@@ -26,11 +23,25 @@
             path: /home/hasenj/manga/conan
             mark1: file_52/image10.png
 
-    The actual section name is not *that* important, you can think of it as an id; it's only something we use internally (more like, something for the config file)
+    The record key (manga_name above) is not *that* important, you can think of it as an id; it's only something we use internally
+
+    We used to keep all that in a config file (powered by `configobj`), but with
+    thousands of mangas, scanning every section to find one by path and rewriting
+    the whole file for every bookmark is too slow, and a crash halfway through a
+    write loses everything. So now the catalog is an sqlite file:
+
+        * name and path are indexed columns, so finding a manga is a lookup
+        * the rest of the record is stored as json next to them
+        * every save is a transaction (journaled), so updates are atomic and only
+          touch the records that changed
 
-"""    
+    The old config file (~/.mangadb) is imported once, the first time the catalog
+    is created; you need configobj for that, but only then.
+
+    The catalog is opened the first time it's used (see `get_db`), not on import.
+"""
 
-import os
+import os, json, sqlite3, threading
 
 def get_config_file_path():
     """Get the location of the config file """
@@ -38,32 +49,265 @@ def get_config_file_path():
         return os.path.expanduser('~')
     elif os.name == 'nt': # windows
         return os.environ['APPDATA']
-        
-from configobj import ConfigObj as conf
 
-db = conf(os.path.join(get_config_file_path(), ".mangadb"))
+SCHEMA = """
+    create table if not exists mangas (
+        key text primary key,
+        name text,
+        path text,
+        record text not null
+    );
+    create index if not exists mangas_by_name on mangas (name);
+    create index if not exists mangas_by_path on mangas (path);
+    create table if not exists meta (
+        key text primary key,
+        value text
+    );
+"""
+
+class Manga(dict):
+    """ A manga record: a dict, with its key in the catalog
+
+        Change it as you like, then save it with `write_to_disk` (or Catalog.save)
+    """
+    def __init__(self, key, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.key = key
+
+PATH_ENCODING = 'utf-8' # how byte string paths are taken (like json and the page index do)
+
+def to_text(path):
+    """ A path as unicode, the way the catalog keeps it (sqlite and json both want
+        unicode); byte strings are taken as utf-8
+
+        @raises UnicodeDecodeError: for byte strings that aren't utf-8
+    """
+    if isinstance(path, str):
+        return path.decode(PATH_ENCODING)
+    return path
+
+def to_bytes(path):
+    """The byte string path that `to_text` made into unicode"""
+    if isinstance(path, unicode):
+        return path.encode(PATH_ENCODING)
+    return path
+
+def text_strings(data):
+    """data with every byte string in it (keys too) made unicode, by `to_text`"""
+    if isinstance(data, dict):
+        return dict((text_strings(key), text_strings(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return [text_strings(item) for item in data]
+    return to_text(data)
+
+def normalize_path(path):
+    if path is None: return None
+    return os.path.normcase(os.path.normpath(to_text(path)))
+
+class Catalog(object):
+    """ The manga catalog, in an sqlite file. Safe to use from several threads
+
+        Records handed out by `get` are cached, so everyone gets the same record
+        for a key, and `write` can save whatever changed in them.
+
+        @param filename: path of the sqlite file; ':memory:' for a temporary catalog
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        try:
+            self.conn.execute("pragma journal_mode=wal") # appends to a journal instead of rewriting pages
+        except sqlite3.DatabaseError:
+            pass # some filesystems can't; the default rollback journal is atomic too
+        self.conn.execute("pragma synchronous=normal")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self.records = {} # key -> Manga, handed out
+        self.saved = {} # key -> the json we last stored, to tell what changed
+
+    def _load(self, row):
+        key, text = row
+        if not self.records.has_key(key):
+            self.records[key] = Manga(key, json.loads(text))
+            self.saved[key] = text
+        return self.records[key]
+
+    def _find(self, column, value):
+        with self.lock:
+            row = self.conn.execute("select key, record from mangas where %s = ?" % column,
+                    (value,)).fetchone()
+            if row is None: return None
+            return self._load(row)
+
+    def has_key(self, key):
+        with self.lock:
+            return self.records.has_key(key) or self._find('key', key) is not None
+
+    def get(self, key):
+        """The record for key, created (empty) if it's not there; a new record only
+           goes to disk when it's saved
+        """
+        with self.lock:
+            manga = self._find('key', key)
+            if manga is None:
+                manga = self.records.setdefault(key, Manga(key))
+            return manga
+
+    def find_by_path(self, path):
+        return self._find('path', normalize_path(path))
+
+    def find_by_name(self, name):
+        return self._find('name', name)
+
+    def keys(self):
+        with self.lock:
+            return [key for key, in self.conn.execute("select key from mangas order by key")]
+
+    def _store(self, manga):
+        """Write manga (within a transaction) if it changed; @returns its json if it did"""
+        text = json.dumps(manga, sort_keys=True)
+        if self.saved.get(manga.key) == text: return None
+        self.conn.execute("insert or replace into mangas (key, name, path, record) values (?, ?, ?, ?)",
+                (manga.key, manga.get('name'), normalize_path(manga.get('path')), text))
+        return text
+
+    def save(self, *mangas):
+        """Save the given records, in one transaction; all of them, or none if it fails"""
+        with self.lock:
+            stored = []
+            with self.conn:
+                for manga in mangas:
+                    text = self._store(manga)
+                    if text is not None:
+                        stored.append((manga.key, text))
+            self.saved.update(stored) # only once it's committed
+
+    def write(self):
+        """Save every record that changed since we loaded it"""
+        self.save(*self.records.values())
+
+    def reload(self):
+        """Forget the records we handed out, so they're read again from the file"""
+        with self.lock:
+            self.records.clear()
+            self.saved.clear()
+
+    def rename(self, oldname, newname):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("update mangas set key = ? where key = ?", (newname, oldname))
+            manga = self.records.pop(oldname, None)
+            if manga is not None:
+                manga.key = newname
+                self.records[newname] = manga
+                if self.saved.has_key(oldname):
+                    self.saved[newname] = self.saved.pop(oldname)
+
+    def delete(self, key):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("delete from mangas where key = ?", (key,))
+            self.records.pop(key, None)
+            self.saved.pop(key, None)
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("select value from meta where key = ?", (key,)).fetchone()
+            return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("insert or replace into meta (key, value) values (?, ?)", (key, value))
+
+    def import_sections(self, sections):
+        """ Add mangas from a mapping of key -> dict of attributes (like the
+            sections of the old config file), all in one transaction.
+            Mangas we already have are left alone, and so are the ones that can't be
+            stored (with a warning)
+
+            @returns: how many were added
+        """
+        with self.lock:
+            added = []
+            for key in sections:
+                try:
+                    manga = Manga(to_text(key), text_strings(dict(sections[key])))
+                    json.dumps(manga)
+                except (UnicodeDecodeError, TypeError, ValueError), e:
+                    print "Warning: can't import manga %r: %s" % (key, e)
+                    continue
+                if not self.has_key(manga.key):
+                    added.append(manga)
+            self.save(*added)
+            return len(added)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def import_configobj(catalog, filename):
+    """ One time import of the old configobj catalog file. Does nothing if it's
+        been done already, or if the file isn't there
+
+        @returns: how many mangas were imported
+    """
+    if catalog.get_meta('imported') or not os.path.exists(filename):
+        return 0
+    from configobj import ConfigObj
+    old = ConfigObj(filename)
+    count = catalog.import_sections(old.dict())
+    catalog.set_meta('imported', filename)
+    return count
+
+def open_catalog(directory=None):
+    """The catalog in `directory` (the user's config directory by default), with the
+       old config file in there imported into it the first time
+    """
+    directory = directory or get_config_file_path()
+    catalog = Catalog(os.path.join(directory, ".mangadb.sqlite"))
+    try:
+        import_configobj(catalog, os.path.join(directory, ".mangadb"))
+    except ImportError:
+        print "can't import the old manga catalog without configobj"
+    except Exception, e: # a broken old file shouldn't keep us from starting
+        print "Warning: couldn't import the old manga catalog:", e
+    return catalog
+
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """The catalog in the user's config directory, opened the first time it's needed"""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = open_catalog()
+        return _db
 
-def write_to_disk(db=db):
-    """low-level function: saves configobj file to disk"""
-    db.write()
+def set_db(catalog):
+    """Use another catalog (e.g. somewhere else) as the default one"""
+    global _db
+    with _db_lock:
+        _db = catalog
 
-def reload(db=db):
-    """low-level function: reload configobj from disk"""
-    if db.filename:
-        db.reload()
+def write_to_disk(db=None):
+    """saves the records that changed to disk"""
+    (db or get_db()).write()
 
-def get_manga(manga_name, db=db):
-    if not db.has_key(manga_name):
-        db[manga_name] = {}
-    return db[manga_name]
+def reload(db=None):
+    """forget unsaved changes, and read records from disk again"""
+    (db or get_db()).reload()
 
-def find_manga_by_path(manga_path, db=db):
-    for key, value in db.items():
-        if value['path'] == path:
-            return value
-    return None
+def get_manga(manga_name, db=None):
+    return (db or get_db()).get(manga_name)
 
-def rename_manga(oldname, newname, db=db):
-    db.rename(oldname, newname)
+def find_manga_by_path(manga_path, db=None):
+    return (db or get_db()).find_by_path(manga_path)
 
+def find_manga_by_name(name, db=None):
+    return (db or get_db()).find_by_name(name)
 
+def rename_manga(oldname, newname, db=None):
+    (db or get_db()).rename(oldname, newname)
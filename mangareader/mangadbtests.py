@@ -0,0 +1,91 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for the manga catalog
+"""
+
+import unittest, os, shutil, sys, tempfile, StringIO
+from mangareader import mangadb
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'catalog.sqlite')
+        self.db = mangadb.Catalog(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def test_get_and_find(self):
+        conan = mangadb.get_manga('detective_conan', self.db)
+        conan['name'] = 'Meitantei Conan'
+        conan['path'] = '/home/hasenj/manga/conan/'
+        conan['marks'] = {'mark1': 'file_52/image10.png'}
+        self.assertTrue(mangadb.get_manga('detective_conan', self.db) is conan)
+        mangadb.write_to_disk(self.db)
+        self.assertTrue(mangadb.find_manga_by_path('/home/hasenj/manga/conan', self.db) is conan)
+        self.assertTrue(mangadb.find_manga_by_name('Meitantei Conan', self.db) is conan)
+        self.assertEqual(mangadb.find_manga_by_path('/elsewhere', self.db), None)
+
+        other = mangadb.Catalog(self.filename) # what's on disk
+        found = other.find_by_path('/home/hasenj/manga/conan')
+        self.assertEqual(found.key, 'detective_conan')
+        self.assertEqual(found['marks'], {'mark1': 'file_52/image10.png'})
+        other.close()
+
+    def test_unsaved_changes(self):
+        manga = self.db.get('one_piece')
+        manga['path'] = '/manga/op'
+        mangadb.reload(self.db)
+        self.assertEqual(self.db.get('one_piece'), {})
+
+    def test_lookup_doesnt_write(self):
+        self.db.get('one_piece')
+        other = mangadb.Catalog(self.filename)
+        self.assertFalse(other.has_key('one_piece'))
+        other.close()
+        self.assertTrue(self.db.has_key('one_piece'))
+        mangadb.rename_manga('one_piece', 'op', self.db)
+        self.db.write()
+        other = mangadb.Catalog(self.filename)
+        self.assertEqual(other.keys(), ['op'])
+        other.close()
+
+    def test_rename(self):
+        self.db.get('conan')['path'] = '/manga/conan'
+        self.db.write()
+        mangadb.rename_manga('conan', 'detective_conan', self.db)
+        self.assertFalse(self.db.has_key('conan'))
+        self.assertEqual(self.db.find_by_path('/manga/conan').key, 'detective_conan')
+        self.assertEqual(self.db.keys(), ['detective_conan'])
+
+    def test_import(self):
+        sections = {
+            'conan': {'name': 'Meitantei Conan', 'path': '/manga/conan', 'marks': {'mark1': 'a/b.png'}},
+            'naruto': {'path': '/manga/naruto'},
+        }
+        self.db.get('naruto')['path'] = '/new/naruto'
+        self.db.write()
+        self.assertEqual(self.db.import_sections(sections), 1) # naruto is already there
+        self.assertEqual(self.db.find_by_name('Meitantei Conan')['marks'], {'mark1': 'a/b.png'})
+        self.assertEqual(self.db.get('naruto')['path'], '/new/naruto')
+
+    def test_import_bad_records(self):
+        sections = {
+            'a': {'path': '/manga/caf\xe9'}, # latin-1; can't be stored
+            'b': {'name': 'Caf\xc3\xa9', 'path': '/manga/b', 'marks': {'mark1': 'cap\xc3\xadtulo/1.png'}},
+            'caf\xc3\xa9': {'path': '/manga/cafe'},
+        }
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO() # keep the warning quiet
+        try:
+            self.assertEqual(self.db.import_sections(sections), 2)
+        finally:
+            sys.stdout = stdout
+        self.assertFalse(self.db.has_key('a'))
+        self.assertEqual(self.db.find_by_name(u'Caf\xe9')['marks'], {'mark1': u'cap\xedtulo/1.png'})
+        self.assertEqual(self.db.find_by_path('/manga/cafe').key, u'caf\xe9')
+
+if __name__ == '__main__':
+    unittest.main()
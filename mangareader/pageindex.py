@@ -0,0 +1,232 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    A persistent index of the pages of a manga, so re-opening it doesn't have to hit
+    the disk for every file again.
+
+    For every directory we've listed, we remember its mtime and its (sorted, filtered)
+    entries, along with which entries are directories. Adding or removing a file changes
+    the mtime of its directory, so a single stat tells us whether the listing is still good.
+
+    For every image, we remember its dimensions (so pages can be laid out right away),
+    and its mtime/size at the time we measured it; if either changed since, the file
+    was edited or replaced, and we measure it again.
+
+    The index is a json file per manga, kept in the user's cache directory:
+
+        {
+            "version": 1,
+            "root": "/path/to/manga",
+            "dirs": {
+                "chapter 01": {"mtime": 1285000000.0, "entries": [["01.jpg", false], ...]},
+                ...
+            },
+            "images": {
+                "chapter 01/01.jpg": [width, height, mtime, size],
+                ...
+            }
+        }
+
+    Paths in the index are relative to the manga root. Directories with names that
+    aren't utf-8 (which json can't hold) are left out, and listed every time.
+"""
+
+import os, json, hashlib, threading
+
+from mangareader import imgsize
+
+VERSION = 1
+
+def get_cache_dir():
+    """Where we keep the index files"""
+    if os.name == 'nt': # windows
+        base = os.environ['APPDATA']
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mangareader', 'index')
+
+def index_file_for(root_path):
+    if isinstance(root_path, unicode):
+        root_path = root_path.encode('utf-8')
+    return os.path.join(get_cache_dir(), hashlib.sha1(root_path).hexdigest() + '.json')
+
+def is_utf8(name):
+    """Can json take this (byte string) name? It decodes them as utf-8"""
+    if isinstance(name, unicode): return True
+    try:
+        name.decode('utf-8')
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def encode_strings(data):
+    """data (as loaded from json), with unicode strings turned back to utf-8 byte
+       strings, which is how json.dumps took them
+    """
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, list):
+        return [encode_strings(item) for item in data]
+    if isinstance(data, dict):
+        return dict((encode_strings(key), encode_strings(value)) for key, value in data.items())
+    return data
+
+class PageIndex(object):
+    """ The page index of one manga
+
+        @param root_path: the (real) path of the manga root directory
+        @param filename: where to keep the index; by default, a file in the cache directory
+    """
+    def __init__(self, root_path, filename=None):
+        self.root_path = root_path
+        self.filename = filename or index_file_for(root_path)
+        self.dirs = {}
+        self.images = {}
+        self.dirty = False
+        self.lock = threading.Lock() # directories can be listed from background threads
+        self.load()
+
+    def relpath(self, path):
+        rel = os.path.relpath(path, self.root_path)
+        if rel == os.curdir: return ''
+        return rel.replace('\\', '/')
+
+    def abspath(self, rel):
+        return os.path.join(self.root_path, *rel.split('/'))
+
+    def listing(self, path):
+        """ The entries of the directory at path, as a list of (name, isdir), if we have them and
+            they're still valid; None otherwise.
+
+            Costs exactly one stat.
+        """
+        rel = self.relpath(path)
+        with self.lock:
+            entry = self.dirs.get(rel)
+        if entry is None: return None
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if mtime != entry['mtime']: return None
+        self._prime_sizes(path, rel, entry['entries'])
+        return entry['entries']
+
+    def record_listing(self, path, entries, mtime):
+        """ Remember the listing of a directory
+
+            @param entries: list of (name, isdir)
+            @param mtime: the mtime of the directory *before* it was listed
+        """
+        rel = self.relpath(path)
+        if not all(is_utf8(name) for name, isdir in entries) or not is_utf8(rel):
+            return # json can't hold the names; this directory will just be listed every time
+        with self.lock:
+            self.dirs[rel] = dict(mtime=mtime, entries=[[name, bool(isdir)] for name, isdir in entries])
+            self.dirty = True
+
+    def _prime_sizes(self, path, rel, entries):
+        """ Tell imgsize about the image sizes we know, so it won't have to read the headers.
+            Costs a stat per image; files that changed since we measured them get their
+            header probed again
+        """
+        prefix = rel + '/' if rel else ''
+        for name, isdir in entries:
+            if isdir: continue
+            image_rel = prefix + name
+            with self.lock:
+                info = self.images.get(image_rel)
+            if info is None: continue
+            image_path = os.path.join(path, name)
+            if self._is_current(info, image_path):
+                imgsize.remember_size(image_path, (info[0], info[1]))
+            else:
+                self._drop_size(image_rel, image_path)
+                imgsize.image_size(image_path) # collect_sizes records it
+
+    def _is_current(self, info, path):
+        """Is the size we remember (info) still good for the file at path?"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return [info[2], info[3]] == [st.st_mtime, st.st_size]
+
+    def _drop_size(self, image_rel, path):
+        with self.lock:
+            if self.images.pop(image_rel, None) is not None:
+                self.dirty = True
+        imgsize.forget_size(path)
+
+    def collect_sizes(self):
+        """ Record the sizes imgsize found out about this session, for images in the directories we know.
+            Costs a stat per image (for its mtime/size); images that changed since we measured
+            them get their header probed again
+        """
+        with self.lock:
+            dirs = self.dirs.items()
+        for rel, entry in dirs:
+            prefix = rel + '/' if rel else ''
+            for name, isdir in entry['entries']:
+                if isdir: continue
+                image_rel = prefix + name
+                if not is_utf8(image_rel): continue # can't go in the index
+                path = self.abspath(image_rel)
+                with self.lock:
+                    info = self.images.get(image_rel)
+                if info is not None:
+                    if self._is_current(info, path): continue
+                    self._drop_size(image_rel, path)
+                    size = imgsize.image_size(path)
+                else:
+                    size = imgsize.cached_size(path)
+                if size is None: continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                with self.lock:
+                    self.images[image_rel] = [size[0], size[1], st.st_mtime, st.st_size]
+                    self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return # no index yet, or a broken one; start from scratch
+        if isinstance(self.root_path, str):
+            data = encode_strings(data) # json gives us unicode; the tree uses byte strings
+        if data.get('version') != VERSION or data.get('root') != self.root_path:
+            return
+        self.dirs = data.get('dirs', {})
+        self.images = data.get('images', {})
+
+    def save(self):
+        """Write the index to disk, if anything changed. The file is replaced atomically"""
+        self.collect_sizes()
+        with self.lock:
+            if not self.dirty: return
+            data = dict(version=VERSION, root=self.root_path, dirs=self.dirs, images=self.images)
+            self.dirty = False # changes made while we write will need another save
+            try:
+                text = json.dumps(data)
+            except UnicodeDecodeError, e:
+                self.dirty = True
+                print "Warning: couldn't save page index:", e
+                return
+        directory = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(text)
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename) # can't rename over an existing file on windows
+            os.rename(tmp, self.filename)
+        except (IOError, OSError), e:
+            with self.lock:
+                self.dirty = True # try again next time
+            print "Warning: couldn't save page index:", e
@@ -0,0 +1,134 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for the persistent page index
+"""
+
+import unittest, os, shutil, tempfile
+from mangareader import fetch, imgsize
+from mangareader.pageindex import PageIndex
+from mangareader.imgsizetests import png_header
+from mangareader.tree.walk import step
+
+def make_tree(root, chapters=3, pages=4):
+    for c in range(chapters):
+        chapter = os.path.join(root, 'ch%02d' % c)
+        os.makedirs(chapter)
+        for p in range(pages):
+            open(os.path.join(chapter, '%02d.png' % p), 'wb').close()
+        open(os.path.join(chapter, 'notes.txt'), 'wb').close() # filtered out
+
+def walk_paths(tree):
+    paths = []
+    node = step(tree, tree.root)
+    while node is not None:
+        paths.append(node.path)
+        node = step(tree, node)
+    return paths
+
+class TestPageIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.old_cache = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
+        self.root = os.path.join(self.tmp, 'manga')
+        make_tree(self.root)
+        self.real_list_entries = fetch.list_entries
+
+    def tearDown(self):
+        fetch.list_entries = self.real_list_entries
+        if self.old_cache is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache
+        shutil.rmtree(self.tmp)
+
+    def test_reopen_without_listing(self):
+        tree = fetch.DirTree(self.root, indexed=True)
+        first_walk = walk_paths(tree)
+        self.assertEqual(len(first_walk), 12)
+        tree.save_index()
+
+        def no_listing(path): raise AssertionError("listed %s" % path)
+        fetch.list_entries = no_listing
+        tree = fetch.DirTree(self.root, indexed=True)
+        self.assertEqual(walk_paths(tree), first_walk)
+
+    def test_changed_directory_is_listed_again(self):
+        tree = fetch.DirTree(self.root, indexed=True)
+        walk_paths(tree)
+        tree.save_index()
+        chapter = os.path.join(tree.root_path, 'ch01')
+        open(os.path.join(chapter, '99.png'), 'wb').close()
+        # make sure the mtime changes even on filesystems with coarse timestamps
+        st = os.stat(chapter)
+        os.utime(chapter, (st.st_atime, st.st_mtime + 10))
+
+        listed = []
+        def counting_list_entries(path):
+            listed.append(path)
+            return self.real_list_entries(path)
+        fetch.list_entries = counting_list_entries
+        tree = fetch.DirTree(self.root, indexed=True)
+        self.assertEqual(len(walk_paths(tree)), 13)
+        self.assertEqual(listed, [chapter])
+
+    def test_image_sizes(self):
+        tree = fetch.DirTree(self.root, indexed=True)
+        paths = walk_paths(tree)
+        imgsize.remember_size(paths[0], (800, 1200))
+        tree.save_index()
+        imgsize.forget_size(paths[0])
+
+        index = PageIndex(tree.root_path)
+        self.assertEqual(index.images['ch00/00.png'][:2], [800, 1200])
+        fetch.DirTree(self.root, indexed=True).root.ls[0].ls # lists ch00 from the index
+        self.assertEqual(imgsize.cached_size(paths[0]), (800, 1200))
+
+    def test_modified_image(self):
+        tree = fetch.DirTree(self.root, indexed=True)
+        paths = walk_paths(tree)
+        open(paths[0], 'wb').write(png_header(800, 1200))
+        self.assertEqual(imgsize.image_size(paths[0]), (800, 1200))
+        tree.save_index()
+
+        imgsize.forget_size(paths[0])
+        open(paths[0], 'wb').write(png_header(600, 900) + 'replaced')
+        tree = fetch.DirTree(self.root, indexed=True)
+        tree.root.ls[0].ls # lists ch00 from the index
+        self.assertEqual(imgsize.cached_size(paths[0]), (600, 900)) # probed again
+        tree.save_index()
+        self.assertEqual(PageIndex(tree.root_path).images['ch00/00.png'][:2], [600, 900])
+        imgsize.forget_size(paths[0])
+
+    def test_non_ascii_root(self):
+        root = os.path.join(self.tmp, 'mang\xc3\xa1') # utf-8 bytes, like the tree has them
+        make_tree(root)
+        tree = fetch.DirTree(root, indexed=True)
+        first_walk = walk_paths(tree)
+        tree.save_index()
+
+        def no_listing(path): raise AssertionError("listed %s" % path)
+        fetch.list_entries = no_listing
+        tree = fetch.DirTree(root, indexed=True)
+        self.assertEqual(walk_paths(tree), first_walk)
+        self.assertTrue(all(isinstance(path, str) for path in walk_paths(tree)))
+
+    def test_latin1_name(self):
+        chapter = os.path.join(self.root, 'ch01')
+        open(os.path.join(chapter, 'p\xe1g.png'), 'wb').write(png_header(10, 20))
+        tree = fetch.DirTree(self.root, indexed=True)
+        paths = walk_paths(tree)
+        self.assertEqual(len(paths), 13)
+        imgsize.image_size(os.path.join(tree.root_path, 'ch01', 'p\xe1g.png'))
+        tree.save_index() # doesn't raise
+
+        index = PageIndex(tree.root_path)
+        self.assertTrue(index.dirs.has_key('ch00'))
+        self.assertFalse(index.dirs.has_key('ch01')) # not indexed
+        tree = fetch.DirTree(self.root, indexed=True)
+        self.assertEqual(walk_paths(tree), paths)
+
+if __name__ == '__main__':
+    unittest.main()
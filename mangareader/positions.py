@@ -0,0 +1,133 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Remember where the user was reading in each manga.
+
+    The position is (page path relative to the manga root, pixel offset into the
+    page), and it changes on every scroll; saving it to the catalog every time
+    would mean dozens of writes a second. So the store is write-behind: `record`
+    only keeps the latest position of each manga in memory, and they're written
+    to the catalog together, `delay` seconds after the first change (in a
+    background thread), and once more on `close`. However many times a position
+    changes in between, it's written once.
+
+    In the catalog, the position is kept in the manga record:
+
+        manga_name:
+            path: /path/to/manga
+            position:
+                page: chapter 01/003.jpg
+                pixel: 250
+"""
+
+import os, threading
+
+from mangareader import mangadb
+
+DEFAULT_DELAY = 2.0 # seconds
+
+class PositionStore(object):
+    """ @param db: the catalog (see mangadb) to keep positions in
+        @param delay: seconds between the first unsaved change and the write
+    """
+    def __init__(self, db=None, delay=DEFAULT_DELAY):
+        self.db = db if db is not None else mangadb.get_db()
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = {} # manga path -> (page, pixel), not written yet
+        self.timer = None
+        self.writes = 0 # how many times we wrote to the catalog
+
+    def record(self, manga_path, page_path, pixel):
+        """ Remember the position in a manga; cheap, call it as often as you like
+
+            @param page_path: path of the page, absolute or relative to manga_path
+        """
+        if os.path.isabs(page_path):
+            page_path = os.path.relpath(page_path, manga_path)
+        with self.lock:
+            self.pending[manga_path] = (page_path, pixel)
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def lookup(self, manga_path):
+        """ The last position in a manga, as (relative page path, pixel), or None
+
+            The page path comes back as a byte string, like the tree has it
+        """
+        with self.lock:
+            if self.pending.has_key(manga_path):
+                return self.pending[manga_path]
+        try:
+            manga = self.db.find_by_path(manga_path)
+        except UnicodeDecodeError:
+            return None # it couldn't have been saved either
+        if manga is None or not manga.has_key('position'): return None
+        position = manga['position']
+        return mangadb.to_bytes(position['page']), position['pixel']
+
+    def flush(self):
+        """ Write the pending positions to the catalog, all in one transaction.
+
+            This runs in the timer thread: the records the GUI may hold are only
+            touched once the write went through. If the write fails, the positions
+            are put back, to be tried again with the next change (or on close)
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel() # in case we're not called by the timer
+                self.timer = None
+        if not pending: return
+        try:
+            with self.db.lock:
+                self._write(pending)
+        except Exception, e:
+            print "Warning: couldn't save reading positions:", e
+            with self.lock:
+                for manga_path, position in pending.items():
+                    self.pending.setdefault(manga_path, position) # newer ones win
+            return
+        self.writes += 1
+
+    def _write(self, pending):
+        updates = [] # (record, position)
+        for manga_path, (page, pixel) in pending.items():
+            try:
+                page = mangadb.to_text(page)
+                manga = self.manga_record(manga_path)
+            except UnicodeDecodeError:
+                print "Warning: can't remember the position in %r; its path isn't %s" % (
+                        manga_path, mangadb.PATH_ENCODING)
+                continue # it never will be; don't try again
+            updates.append((manga, dict(page=page, pixel=pixel)))
+        changed = []
+        for manga, position in updates:
+            copy = mangadb.Manga(manga.key, manga)
+            copy['position'] = position
+            changed.append(copy)
+        self.db.save(*changed)
+        for manga, position in updates:
+            manga['position'] = position # now it matches what's on disk
+
+    def manga_record(self, manga_path):
+        """The catalog record of the manga at manga_path, made up if there's none"""
+        manga = self.db.find_by_path(manga_path)
+        if manga is not None: return manga
+        manga_path = mangadb.to_text(manga_path)
+        name = os.path.basename(os.path.normpath(manga_path)) or u'manga'
+        key, n = name, 1
+        while self.db.has_key(key):
+            n += 1
+            key = u"%s_%d" % (name, n)
+        manga = self.db.get(key)
+        manga['name'] = name
+        manga['path'] = manga_path
+        return manga
+
+    def close(self):
+        """Write whatever is pending; call on exit"""
+        self.flush()
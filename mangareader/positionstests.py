@@ -0,0 +1,99 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for remembering reading positions
+"""
+
+import unittest, os, shutil, sys, tempfile, time, StringIO
+from mangareader import mangadb
+from mangareader.positions import PositionStore
+from mangareader.fetchtests import wait_for
+
+class TestPositionStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'catalog.sqlite')
+        self.db = mangadb.Catalog(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def saved_position(self, manga_path):
+        """what's on disk"""
+        other = mangadb.Catalog(self.filename)
+        try:
+            manga = other.find_by_path(manga_path)
+            return manga and manga.get('position')
+        finally:
+            other.close()
+
+    def test_coalesced(self):
+        store = PositionStore(self.db, delay=0.2)
+        for pixel in range(100):
+            store.record('/manga/conan', '/manga/conan/vol1/%03d.png' % (pixel / 10), pixel)
+        self.assertEqual(store.lookup('/manga/conan'), ('vol1/009.png', 99))
+        self.assertEqual(self.saved_position('/manga/conan'), None) # not yet
+        self.assertTrue(wait_for(lambda: store.writes == 1))
+        self.assertEqual(self.saved_position('/manga/conan'), dict(page='vol1/009.png', pixel=99))
+        time.sleep(0.3)
+        self.assertEqual(store.writes, 1)
+
+    def test_close_flushes(self):
+        store = PositionStore(self.db, delay=60)
+        store.record('/manga/conan', 'vol2/001.png', 10)
+        store.record('/manga/naruto', 'ch3/005.png', 0)
+        store.close()
+        self.assertEqual(store.writes, 1) # both in one go
+        self.assertEqual(self.saved_position('/manga/naruto'), dict(page='ch3/005.png', pixel=0))
+        store = PositionStore(mangadb.Catalog(self.filename))
+        self.assertEqual(store.lookup('/manga/conan'), ('vol2/001.png', 10))
+        self.assertEqual(store.lookup('/manga/unknown'), None)
+
+    def test_existing_record(self):
+        conan = self.db.get('detective_conan')
+        conan['path'] = '/manga/conan'
+        self.db.write()
+        other = self.db.get('conan')
+        other['path'] = '/elsewhere/conan'
+        self.db.write()
+        store = PositionStore(self.db, delay=60)
+        store.record('/manga/conan', 'vol1/001.png', 5)
+        store.record('/other/conan', 'vol1/001.png', 7)
+        store.close()
+        self.assertEqual(conan['position'], dict(page='vol1/001.png', pixel=5))
+        self.assertEqual(self.db.find_by_path('/other/conan').key, 'conan_2')
+
+    def test_non_ascii_paths(self):
+        store = PositionStore(self.db, delay=60)
+        store.record('/manga/mang\xc3\xa1', 'cap\xc3\xadtulo 1/001.png', 5)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO() # keep the warning quiet
+        try:
+            store.record('/manga/latin1', 'cap\xedtulo 1/001.png', 7) # not utf-8; can't be saved
+            store.close()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(store.writes, 1)
+        store = PositionStore(mangadb.Catalog(self.filename))
+        position = store.lookup('/manga/mang\xc3\xa1')
+        self.assertEqual(position, ('cap\xc3\xadtulo 1/001.png', 5))
+        self.assertTrue(isinstance(position[0], str)) # like the tree has it
+        self.assertEqual(store.lookup('/manga/latin1'), None)
+        self.assertEqual(store.pending, {}) # dropped, not retried forever
+
+    def test_failed_write_is_kept(self):
+        store = PositionStore(self.db, delay=60)
+        store.record('/manga/conan', 'vol1/001.png', 5)
+        self.db.close()
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            store.flush()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(store.writes, 0)
+        self.assertEqual(store.lookup('/manga/conan'), ('vol1/001.png', 5))
+        self.db = mangadb.Catalog(self.filename) # for tearDown
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,11 +8,13 @@
 # system imports
 import os
 import sys
+import time
 
 # Qt imports
 from PyQt4 import QtGui, QtCore
 
 # widget imports
+from mangareader import bgloader, sharedmem
 from mangareader.widgets import fstrip, mscroll
 from widgets.manga_frame import MangaFrame
 
@@ -27,12 +29,19 @@ test_path = ''
 # constants    
 g_step = 30
 g_big_step = 600
+g_smooth_scrolling = False # ease into keyboard/wheel scrolls instead of jumping
+g_kinetic_scrolling = True # keep scrolling after a drag, slowing down
+g_fling_window = 0.1 # seconds; the fling speed is measured over the last part of the drag
+g_adaptive_read_ahead = False # size the prefetch window by reading speed, instead of a fixed 3/10 pages
+g_decode_in_processes = False # decode pages in a process pool instead of the loader threads (posix only)
 
 class MainWindow(QtGui.QWidget):
     def __init__(self, startdir):
         QtGui.QMainWindow.__init__(self, None)
         self.current_manga_path = startdir # for use in the open folder dialoge
-        self.manga_frame = MangaFrame(startdir)
+        self.manga_frame = MangaFrame(startdir, adaptive_read_ahead=g_adaptive_read_ahead)
+        self.manga_frame.smooth_scrolling = g_smooth_scrolling
+        self.pan_history = [] # (time, delta) of the mouse moves in the current drag
 
         vbox_container = QtGui.QVBoxLayout()
         vbox_container.addWidget(self.manga_frame)
@@ -81,17 +90,20 @@ class MainWindow(QtGui.QWidget):
             self.choose_chapter()
         if key == ':':
             print "cmdbar TODO"
+        if key == 's':
+            self.manga_frame.print_stats()
         if key == 'z':
             self.manga_frame.zoom_in(10)
         if key == 'x':
             self.manga_frame.zoom_out(10)
         if key == 'Z':
             self.manga_frame.reset_zoom()
-        self.manga_frame.repaint()
 
     def mousePressEvent(self, event):
         btn = event.button()
         self.posMouseOrigin = event.pos()
+        self.manga_frame.stop_scrolling()
+        self.pan_history = []
         if btn == QtCore.Qt.LeftButton:
             self.setCursor(self.cursors['pan'])
             self.funcMouseMove = self.mousePan
@@ -101,23 +113,27 @@ class MainWindow(QtGui.QWidget):
 
     def mouseReleaseEvent(self, event):
         self.setCursor(self.cursors['default'])
+        if g_kinetic_scrolling and self.pan_history:
+            now = time.time()
+            recent = [delta for t, delta in self.pan_history if now - t < g_fling_window]
+            if recent:
+                self.manga_frame.fling(sum(recent) / g_fling_window)
+        self.pan_history = []
 
     def mouseMoveEvent(self, event):
         delta = self.posMouseOrigin.y() - event.pos().y()
         self.funcMouseMove(delta)
         self.posMouseOrigin = event.pos()
-        self.manga_frame.repaint()
 
     def mouseDoubleClickEvent(self, event):
         self.manga_frame.reset_zoom()
-        self.manga_frame.repaint()
 
     def wheelEvent(self, event):
         self.manga_frame.scrollDown(-event.delta())
-        self.manga_frame.repaint()
 
     def mousePan(self, delta):
         self.manga_frame.scrollDown(delta)
+        self.pan_history.append((time.time(), delta))
 
     def mouseZoom(self, delta):
         self.manga_frame.zoom_out(delta)
@@ -132,13 +148,21 @@ def main():
         startdir = test_path
     if not os.path.exists(startdir):
         startdir = ''
+    if g_decode_in_processes and sharedmem.available():
+        bgloader.set_job_backend("image_loader", "process")
+        bgloader.get_process_pool("image_loader") # fork now, before any threads or Qt
+    elif g_decode_in_processes:
+        print "Warning: can't decode in processes here (no /dev/shm); decoding in threads"
     qapp = QtGui.QApplication(sys.argv)
     window = MainWindow(startdir)
     window.resize(1000, 800)
     window.setWindowTitle("Manga Reader")
     window.setWindowIcon(QtGui.QIcon('art/icon.png'))
     window.show()
-    sys.exit(qapp.exec_())
+    qapp.connect(qapp, QtCore.SIGNAL("aboutToQuit()"), window.manga_frame.close_manga)
+    status = qapp.exec_()
+    bgloader.stop_process_pools()
+    sys.exit(status)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,170 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Read-ahead policies: how many pages to keep (and decode) around the cursor.
+
+    A policy is told about every page change and every finished decode, and is asked
+    for the window size whenever the cursor moves to another page:
+
+        policy.observe_move(pages, now)     # the cursor moved `pages` pages (negative: backward)
+        policy.observe_decode(seconds)      # decoding one page took `seconds`
+        policy.window(now)                  # -> (items_before, items_after)
+
+    `StaticReadAhead` is the plain fixed window. `AdaptiveReadAhead` sizes the window
+    from the reading speed and the loader throughput, so the pages about to be
+    shown are decoded just in time.
+
+    `replay` runs a policy against a recorded (or made up) reading session with a
+    simulated loader, so policies can be compared without a GUI.
+"""
+
+import math, time, threading
+
+from mangareader.widgets.scrolling import load_priority, FORWARD, BACKWARD
+
+IDLE_SPEED = 1 / 60.0 # pages per second; anything slower is just sitting there
+
+class StaticReadAhead(object):
+    """ Always keep `before` pages before the cursor, and `after` pages after it """
+    def __init__(self, before=3, after=10):
+        self.before = before
+        self.after = after
+    def observe_move(self, pages, now=None):
+        pass
+    def observe_decode(self, seconds):
+        pass
+    def window(self, now=None):
+        return self.before, self.after
+
+class AdaptiveReadAhead(object):
+    """ Keep enough pages ahead of the reader that each one is decoded by the time
+        the reader gets to it.
+
+        The reading speed (pages per second) is a moving average of the page
+        changes, which fades away when the reader stops. The loader throughput is
+        `workers` pages per decode time, where the decode time is a moving average
+        of what the loader reports.
+
+        If the reader goes at v pages/sec, and the loader does T pages/sec, a page
+        queued now is ready after (latency + queue/T) seconds, while the reader gets
+        there after (distance/v) seconds. The smallest window that covers this is
+
+            ahead = v * (latency + slack) / (1 - v/T)
+
+        and when v >= T the loader can't keep up at all, so we queue as much as we're
+        allowed to. "Ahead" follows the reading direction; the other side gets `behind`.
+
+        @param behind: pages to keep on the side we're coming from
+        @param min_ahead, max_ahead: bounds of the window on the side we're going to
+        @param workers: how many pages the loader decodes at the same time
+        @param slack: seconds of margin on top of the decode time
+        @param half_life: seconds it takes the speed estimate to fade to half when the reader stops
+    """
+    def __init__(self, behind=3, min_ahead=5, max_ahead=40, workers=1, slack=0.5, half_life=1.0,
+            decode_seconds=0.1):
+        self.behind = behind
+        self.min_ahead = min_ahead
+        self.max_ahead = max_ahead
+        self.workers = max(1, workers)
+        self.slack = slack
+        self.tau = half_life / math.log(2)
+        self.decode_seconds = decode_seconds # until we measure it
+        self.decodes = 0
+        self.velocity = 0.0 # pages per second, as of last_move
+        self.last_move = None
+        self.direction = FORWARD
+        self.lock = threading.Lock() # decodes are reported from the loader threads
+
+    def observe_move(self, pages, now=None):
+        if not pages: return
+        if now is None: now = time.time()
+        self.direction = FORWARD if pages > 0 else BACKWARD
+        if self.last_move is None:
+            self.last_move = now
+            return
+        elapsed = max(now - self.last_move, 0.01)
+        weight = 1 - math.exp(-elapsed / self.tau) # the longer since the last move, the less the old speed counts
+        self.velocity += weight * (pages / elapsed - self.velocity)
+        self.last_move = now
+
+    def observe_decode(self, seconds):
+        with self.lock:
+            self.decodes += 1
+            # a plain average of the first few, so the initial guess goes away quickly
+            self.decode_seconds += max(0.2, 1.0 / self.decodes) * (seconds - self.decode_seconds)
+
+    def speed(self, now=None):
+        """Pages per second, negative when reading backward"""
+        if self.last_move is None: return 0.0
+        if now is None: now = time.time()
+        return self.velocity * math.exp(-max(now - self.last_move, 0) / self.tau)
+
+    def window(self, now=None):
+        speed = abs(self.speed(now))
+        with self.lock:
+            latency = self.decode_seconds
+        throughput = self.workers / max(latency, 0.001)
+        if speed < IDLE_SPEED:
+            ahead = self.min_ahead
+        elif speed >= throughput:
+            ahead = self.max_ahead
+        else:
+            ahead = self.min_ahead + int(math.ceil(speed * (latency + self.slack) / (1 - speed / throughput)))
+            ahead = min(ahead, self.max_ahead)
+        if self.direction == BACKWARD:
+            return ahead, self.behind
+        return self.behind, ahead
+
+def replay(policy, moves, decode_seconds=0.1, workers=1, page_count=None):
+    """ Run `policy` against a reading session, with a simulated loader that works
+        like the real one: `workers` decoders, taking the pages of the window nearest
+        to the cursor first, and dropping what falls out of the window before it starts.
+
+        @param moves: list of (time, page): the reader is on `page` from `time` on;
+            in time order
+        @param decode_seconds: how long it takes to decode one page
+        @returns: dict with
+            stalls: how many times the reader got to a page that wasn't decoded yet
+            decoded: how many pages got decoded
+            max_window: the biggest window (before + 1 + after) the policy asked for
+            last_window: the window the policy asked for at the end of the session
+        The reader can stay on a page for several entries; the policy is asked for
+        the window at each of them.
+    """
+    if page_count is None:
+        page_count = max(page for t, page in moves) + 1
+    decoded = {} # page -> when it's done decoding
+    worker_free = [0.0] * max(1, workers) # when each worker is done with what it's doing
+    queue = []
+    stats = dict(stalls=0, decoded=0, max_window=0, last_window=None)
+
+    def advance(now, until):
+        """let the loader run from `now` until `until`"""
+        while queue:
+            worker = min(range(len(worker_free)), key=worker_free.__getitem__)
+            start = max(worker_free[worker], now)
+            if start >= until: break
+            page = queue.pop(0)
+            decoded[page] = worker_free[worker] = start + decode_seconds
+            policy.observe_decode(decode_seconds) # the simulator knows how long it'll take
+            stats['decoded'] += 1
+
+    now, current, direction = None, None, FORWARD
+    for when, page in moves:
+        if now is not None:
+            advance(now, when)
+        now = when
+        if decoded.get(page, when + 1) > when:
+            stats['stalls'] += 1
+        if current is not None and page != current:
+            policy.observe_move(page - current, when)
+            direction = FORWARD if page > current else BACKWARD
+        current = page
+        before, after = policy.window(when)
+        stats['max_window'] = max(stats['max_window'], before + 1 + after)
+        stats['last_window'] = (before, after)
+        first, end = max(0, page - before), min(page_count, page + after + 1)
+        queue[:] = sorted((p for p in range(first, end) if not decoded.has_key(p)),
+                key=lambda p: load_priority(p, page, direction))
+    return stats
@@ -0,0 +1,84 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    unit tests for the read-ahead policies, mostly by replaying reading sessions
+"""
+
+import unittest
+from mangareader.readahead import StaticReadAhead, AdaptiveReadAhead, replay
+
+def session(first, step, count, interval, start=0.0):
+    """Turn a page every `interval` seconds, `count` times"""
+    return [(start + i * interval, first + i * step) for i in range(count)]
+
+class TestStaticReadAhead(unittest.TestCase):
+    def test_window(self):
+        policy = StaticReadAhead(3, 10)
+        policy.observe_move(5, 1.0)
+        policy.observe_decode(2.0)
+        self.assertEqual(policy.window(1.0), (3, 10))
+
+class TestAdaptiveReadAhead(unittest.TestCase):
+    def test_idle(self):
+        policy = AdaptiveReadAhead(behind=3, min_ahead=5)
+        self.assertEqual(policy.window(0.0), (3, 5))
+
+    def test_grows_with_speed_and_fades(self):
+        policy = AdaptiveReadAhead(behind=3, min_ahead=5, max_ahead=40, workers=2)
+        for when, page in session(0, 1, 20, 0.2):
+            policy.observe_move(1, when)
+            policy.observe_decode(0.3)
+        before, after = policy.window(3.8)
+        self.assertEqual(before, 3)
+        self.assertTrue(after > 10)
+        self.assertEqual(policy.window(60.0), (3, 5)) # the reader stopped a while ago
+
+    def test_loader_cant_keep_up(self):
+        policy = AdaptiveReadAhead(max_ahead=40, workers=1)
+        for when, page in session(0, 1, 20, 0.1):
+            policy.observe_move(1, when)
+            policy.observe_decode(0.5) # 2 pages per second, the reader does 10
+        self.assertEqual(policy.window(1.9)[1], 40)
+
+    def test_backward(self):
+        policy = AdaptiveReadAhead(behind=3, min_ahead=5)
+        for when, page in session(100, -1, 20, 0.2):
+            policy.observe_move(-1, when)
+            policy.observe_decode(0.3)
+        before, after = policy.window(3.8)
+        self.assertTrue(before > 10)
+        self.assertEqual(after, 3)
+
+class TestReplay(unittest.TestCase):
+    def test_reading_backward(self):
+        moves = session(100, -1, 60, 0.3)
+        static = replay(StaticReadAhead(), moves, decode_seconds=1.0, workers=4)
+        adaptive = replay(AdaptiveReadAhead(workers=4), moves, decode_seconds=1.0, workers=4)
+        self.assertEqual(static['stalls'], 60) # 3 pages back is never enough
+        self.assertTrue(adaptive['stalls'] < 30, adaptive)
+
+    def test_reading_slowly(self):
+        moves = session(0, 1, 20, 8.0)
+        static = replay(StaticReadAhead(), moves, decode_seconds=0.3, workers=2, page_count=100)
+        adaptive = replay(AdaptiveReadAhead(workers=2), moves, decode_seconds=0.3, workers=2, page_count=100)
+        self.assertEqual(adaptive['stalls'], static['stalls'])
+        self.assertTrue(adaptive['decoded'] < static['decoded'], (adaptive, static))
+
+    def test_skimming(self):
+        moves = session(0, 1, 100, 0.1)
+        static = replay(StaticReadAhead(), moves, decode_seconds=0.5, workers=8, page_count=200)
+        adaptive = replay(AdaptiveReadAhead(workers=8), moves, decode_seconds=0.5, workers=8, page_count=200)
+        self.assertTrue(adaptive['stalls'] <= static['stalls'], (adaptive, static))
+        self.assertTrue(adaptive['max_window'] > static['max_window'])
+
+    def test_shrinks_after_pause(self):
+        moves = session(0, 1, 40, 0.1)
+        moves += [(4.0 + pause, 39) for pause in (1.0, 5.0, 20.0)] # sitting on the last page
+        stats = replay(AdaptiveReadAhead(behind=3, min_ahead=5, workers=2), moves,
+                decode_seconds=0.5, workers=2, page_count=100)
+        self.assertTrue(stats['max_window'] > 20, stats)
+        self.assertEqual(stats['last_window'], (3, 5))
+
+if __name__ == '__main__':
+    unittest.main()
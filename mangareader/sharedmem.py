@@ -0,0 +1,49 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Hand big buffers (decoded pixels) from a worker process to us without pickling
+    them through a pipe.
+
+    The worker writes the buffer to a file in shared memory (/dev/shm) and sends
+    back the file name; we map the file, and the name goes away right after, so
+    nothing is left behind if we crash. Removing a file that's still mapped is a
+    posix thing, and /dev/shm a linux one; check `available` first.
+
+    @note: on python 2, every mapping holds a file descriptor until it's closed,
+        so close mappings as soon as you're done with them
+"""
+
+import os, mmap, tempfile
+
+PREFIX = 'mangareader-'
+SHARED_DIR = '/dev/shm' # memory backed, so the buffers never hit the disk
+
+def available():
+    """Can we hand buffers over this way on this system?"""
+    return os.name == 'posix' and os.path.isdir(SHARED_DIR)
+
+def export(data):
+    """ Put data (a string or buffer) in shared memory
+
+        @returns: the name to `attach` it with
+    """
+    fd, name = tempfile.mkstemp(prefix=PREFIX, dir=SHARED_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+    except:
+        os.remove(name)
+        raise
+    return name
+
+def attach(name):
+    """ Map the buffer `export` put in shared memory, and remove its name
+
+        @returns: a (private, writable) mmap of the buffer
+    """
+    try:
+        with open(name, 'r+b') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    finally:
+        os.remove(name)
@@ -29,6 +29,11 @@ class INode(object):
     def ls(self):
         """return a list of child nodes. Only for directories"""
         raise NotImplemented
+    @property
+    def position(self):
+        """the index of this node in its parent's `ls`; None for the root.
+            Walking uses this to find siblings without searching the parent's list"""
+        raise NotImplemented
 
 class ITree(object):
     """The node only carries information about its children, we need an encompassing
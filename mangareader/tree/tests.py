@@ -16,6 +16,7 @@ class FakeNode(object):
     def __init__(self, name, children=None):
         self.name = name
         self.parent = None
+        self.position = None
         if children is None:
             self.isdir = False
             self.isfile = True
@@ -23,8 +24,9 @@ class FakeNode(object):
             self.isdir = True
             self.isfile = False
             self.ls = children
-            for node in self.ls:
+            for position, node in enumerate(self.ls):
                 node.parent = self # the tree can be dumb! we manage our own parents!
+                node.position = position
     def __repr__(self):
         return "[node \"%s\"]" % self.name
 
@@ -183,6 +185,25 @@ class TestWalkingWithDeeplyNestedNodes(TestBasicWalking):
                     )
         )
 
+class UnsearchableList(list):
+    def index(self, item):
+        raise AssertionError("walking should not search the parent's list")
+
+class TestSiblingLookup(unittest.TestCase):
+    def test_uses_position(self):
+        pages = UnsearchableList(FakeNode(name=str(i).zfill(4)) for i in range(100))
+        tree = FakeTree(FakeNode(name='root', children=pages))
+        node = step(tree, tree.root)
+        names = []
+        while node is not None:
+            names.append(node.name)
+            node = step(tree, node)
+        self.assertEqual(names, [page.name for page in pages])
+
+    def test_empty_root(self):
+        tree = FakeTree(FakeNode(name='root', children=[]))
+        self.assertTrue(step(tree, tree.root) is None)
+
 class TestContextWithDeeplyNestedNodes(unittest.TestCase):
     def setUp(self):
         node6 = FakeNode(name='06')
@@ -104,7 +104,7 @@ def step(tree, node, dir='next'):
         root = tree.root
         while True:
             node = tree.parent(node)
-            if node is root: break
+            if node is None or node is root: break
             sibling = get_sibling(tree, node)
             if sibling is not None:
                 return handle_sibling_exists(sibling)
@@ -125,7 +125,8 @@ def step(tree, node, dir='next'):
 
 def node_sibling(parent, node, offset):
     """Get the sibling of the node that's offset steps away"""
-    index = parent.ls.index(node)
+    index = node.position # O(1); searching parent.ls would make walking a directory O(n^2)
+    if index is None: return None # the root has no siblings
     sibdex = index + offset
     if 0 <= sibdex < len(parent.ls):
         return parent.ls[sibdex]
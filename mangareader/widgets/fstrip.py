@@ -9,30 +9,271 @@
     A manga strip is an "infinite" list of images that can be scrolled up and down.
 """
 
+import time, itertools
+from collections import deque
+from contextlib import contextmanager
+
 from PyQt4 import QtGui, QtCore
 
-def load_image(image_path, width=None):
+from mangareader import archive
+
+TILE_HEIGHT = 1024 # rows per pixmap tile of a tall page
+MAX_IMAGE_HEIGHT = 32767 # QPainter (and some image backends) can't handle taller images
+LOAD_TILE_HEIGHT = 8192 # rows per image tile, when we have to load a picture in pieces
+
+class MemberDevice(QtCore.QIODevice):
+    """ A read-only QIODevice over an archive member, as it comes from read_buffer:
+        a stored member is read straight out of the archive's memory map, so its
+        data is never copied whole. The archive is held until the device is closed
+    """
+    def __init__(self, archive_path, member):
+        QtCore.QIODevice.__init__(self)
+        self.archive = archive.pool.acquire(archive_path)
+        try:
+            self.data = self.archive.read_buffer(member)
+        except:
+            self.close()
+            raise
+    def size(self):
+        return len(self.data)
+    def isSequential(self):
+        return False
+    def readData(self, maxlen):
+        pos = self.pos()
+        return str(self.data[pos:pos + maxlen])
+    def writeData(self, data):
+        return -1
+    def close(self):
+        QtCore.QIODevice.close(self)
+        self.data = None
+        held, self.archive = self.archive, None
+        if held is not None:
+            archive.pool.release(held)
+
+@contextmanager
+def image_reader(image_path):
+    """ with image_reader(path) as reader: ...
+
+        A QImageReader for the picture at image_path, which can be inside an archive
+        (then the reader decodes from the archive's memory; no temp files)
+    """
+    located = archive.split_path(image_path)
+    if located is None:
+        yield QtGui.QImageReader(image_path)
+        return
+    try:
+        device = MemberDevice(*located)
+    except archive.ArchiveError, e:
+        print "Warning:", e
+        yield QtGui.QImageReader() # reads nothing
+        return
+    try:
+        device.open(QtCore.QIODevice.ReadOnly)
+        yield QtGui.QImageReader(device)
+    finally:
+        device.close()
+
+def image_size(image_path):
+    """Read the size of a picture from its header, without decoding it
+       @returns: (width, height), or None if the picture can't be read
+    """
+    with image_reader(image_path) as reader:
+        size = reader.size()
+    if not size.isValid(): return None
+    return size.width(), size.height()
+
+def load_image(image_path, width=None, height=None):
     """Load a picture into a frame
-       @param width: optional, if present, scale image width to match width
+       @param width: optional, if present and smaller than the picture, decode the 
+       picture scaled down to width (jpeg does this much faster than a full decode)
+       @param height: optional, the height to go with width; by default it keeps 
+       the aspect ratio
        @returns: a frame object
        @note: really, it returns a QImage, but we pretend it's not a qt object, but rather
        a frame object!!!
+       @note: pictures taller than MAX_IMAGE_HEIGHT (after scaling) come as a TiledImage
+    """
+    with image_reader(image_path) as reader:
+        size = reader.size()
+        if width is not None and size.isValid() and width < size.width():
+            if height is None:
+                height = max(1, int(round(size.height() * float(width) / size.width())))
+            reader.setScaledSize(QtCore.QSize(width, height))
+        elif size.isValid():
+            width, height = size.width(), size.height()
+        if not (size.isValid() and height > MAX_IMAGE_HEIGHT):
+            return reader.read()
+    return load_tiled_image(image_path, size, width, height)
+
+def load_tiled_image(image_path, size, width, height):
+    """Load a (very tall) picture as a TiledImage, decoding one strip of rows at a time
+
+       Only formats whose reader can clip (e.g. jpeg) are decoded a strip at a time;
+       for the others (png, gif) Qt would decode the whole picture for every strip,
+       so we decode it once and cut it up instead
+
+       @param size: QSize of the picture
+       @param width, height: the size to decode it at
     """
-    return QtGui.QImage(image_path)
+    with image_reader(image_path) as reader:
+        if not reader.supportsOption(QtGui.QImageIOHandler.ClipRect):
+            reader.setScaledSize(QtCore.QSize(width, height))
+            image = reader.read()
+            if image.isNull(): return image # broken (or too big) picture; same as a failed read()
+            return TiledImage([(top, image.copy(0, top, width, min(LOAD_TILE_HEIGHT, height - top)))
+                    for top in range(0, height, LOAD_TILE_HEIGHT)])
+    tiles = []
+    for top in range(0, height, LOAD_TILE_HEIGHT):
+        bottom = min(top + LOAD_TILE_HEIGHT, height)
+        # the rows of the picture that end up in this tile
+        source_top = int(round(top * float(size.height()) / height))
+        source_bottom = int(round(bottom * float(size.height()) / height))
+        with image_reader(image_path) as reader: # a reader only reads once
+            reader.setClipRect(QtCore.QRect(0, source_top, size.width(), max(1, source_bottom - source_top)))
+            reader.setScaledSize(QtCore.QSize(width, bottom - top))
+            tile = reader.read()
+        if tile.isNull(): return tile # broken picture; same as a failed read()
+        tiles.append((top, tile))
+    return TiledImage(tiles)
 
-def paint_frame(painter, frame, y):
-    """Draw a single frame at vertical position `y` """
+class TiledImage(object):
+    """ A picture too tall for one QImage, kept as a stack of images (webtoons can 
+        be a single image, hundreds of thousands of pixels tall)
+
+        Provides the part of the QImage interface the reader uses, so it can stand 
+        in for a frame
+    """
+    _keys = itertools.count(1)
+    def __init__(self, tiles):
+        self.tiles = tiles # list of (top, QImage)
+        self._width = tiles[0][1].width()
+        self._height = sum(tile.height() for top, tile in tiles)
+        self._key = -self._keys.next() # negative, so it won't clash with QImage keys
+    def width(self):
+        return self._width
+    def height(self):
+        return self._height
+    def depth(self):
+        return self.tiles[0][1].depth()
+    def rect(self):
+        return QtCore.QRect(0, 0, self._width, self._height)
+    def isNull(self):
+        return False
+    def cacheKey(self):
+        return self._key
+    def scaled(self, width, height, aspect_mode, transform_mode):
+        """Scale every tile; the tile edges are rounded so the heights add up to `height` exactly"""
+        ratio = float(height) / self._height
+        tiles = []
+        for top, tile in self.tiles:
+            new_top = int(round(top * ratio))
+            new_bottom = int(round((top + tile.height()) * ratio))
+            if new_bottom > new_top:
+                tiles.append((new_top, tile.scaled(width, new_bottom - new_top, 
+                        QtCore.Qt.IgnoreAspectRatio, transform_mode)))
+        return TiledImage(tiles)
+    def paint(self, painter, x, y, target):
+        """Draw the part of the tiles (placed at x, y) that falls inside the `target` rect"""
+        for top, tile in self.tiles:
+            part = QtCore.QRect(x, y + top, tile.width(), tile.height()).intersected(target)
+            if part.isEmpty(): continue
+            painter.drawImage(part, tile, part.translated(-x, -y - top))
+
+def image_tiles(image):
+    """The (top, QImage) pieces of a frame"""
+    if isinstance(image, TiledImage):
+        return image.tiles
+    return [(0, image)]
+
+class Placeholder(object):
+    """A frame that's not loaded yet, but whose size we already know"""
+    color = QtGui.QColor(128, 128, 128)
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+    def rect(self):
+        return QtCore.QRect(0, 0, self.width, self.height)
+
+class RateCounter(object):
+    """Counts events, and tells how many happened per second over the last `window` seconds"""
+    def __init__(self, window=5.0):
+        self.window = window
+        self.total = 0
+        self.times = deque()
+    def count(self):
+        now = time.time()
+        self.total += 1
+        self.times.append(now)
+        self._expire(now)
+    def rate(self):
+        self._expire(time.time())
+        return len(self.times) / self.window
+    def _expire(self, now):
+        while self.times and self.times[0] < now - self.window:
+            self.times.popleft()
+
+# how often we turn an image into pixmaps; should only happen when a page 
+# comes into view, or the zoom level changes
+conversions = RateCounter()
+
+class TiledPixmap(object):
+    """ A frame converted to pixmaps, ready to be blitted to the screen.
+
+        Drawing a QImage means converting (and uploading) it on every paint; 
+        here we pay for that only once. Tall pages are cut into tiles of 
+        TILE_HEIGHT rows, so painting a strip of a long page only touches the 
+        tiles in the strip, and no pixmap gets too big for the graphics system.
+
+        @note: pixmaps can only be made in the GUI thread
+    """
+    def __init__(self, image):
+        self.width, self.height = image.width(), image.height()
+        self.source_key = image.cacheKey() # tells which image we were made from
+        self.tiles = []
+        for piece_top, piece in image_tiles(image):
+            if piece.height() <= TILE_HEIGHT:
+                self.tiles.append((piece_top, QtGui.QPixmap.fromImage(piece)))
+                continue
+            for top in range(0, piece.height(), TILE_HEIGHT):
+                tile = piece.copy(0, top, self.width, min(TILE_HEIGHT, piece.height() - top))
+                self.tiles.append((piece_top + top, QtGui.QPixmap.fromImage(tile)))
+        conversions.count()
+    def rect(self):
+        return QtCore.QRect(0, 0, self.width, self.height)
+    def paint(self, painter, x, y, target):
+        """Draw the part of the tiles (placed at x, y) that falls inside the `target` rect"""
+        for top, pixmap in self.tiles:
+            part = QtCore.QRect(x, y + top, pixmap.width(), pixmap.height()).intersected(target)
+            if part.isEmpty(): continue
+            painter.drawPixmap(part, pixmap, part.translated(-x, -y - top))
+
+def paint_frame(painter, frame, y, clip=None):
+    """Draw a single frame at vertical position `y`
+       @param clip: optional QRect; only the part of the frame inside it gets drawn
+    """
     padding = painter.viewport().width() - frame.rect().width()
     x = int(padding/2)
-    painter.drawImage(QtCore.QPoint(x,y), frame)
+    target = frame.rect().translated(x, y)
+    if clip is not None:
+        target = target.intersected(clip)
+        if target.isEmpty(): return
+    if isinstance(frame, Placeholder):
+        painter.fillRect(target, frame.color)
+    elif isinstance(frame, (TiledPixmap, TiledImage)):
+        frame.paint(painter, x, y, target)
+    else:
+        painter.drawImage(target, frame, target.translated(-x, -y))
 
-def paint_frames(painter, frames, y):
-    """Draw a list of frames starting at vertical position `y`"""
-    while frames and y < painter.viewport().height():
-        frame = frames[0]
+def paint_frames(painter, frames, y, clip=None):
+    """Draw a list of frames starting at vertical position `y`
+       @param clip: optional QRect of the area that needs painting (e.g. the strip 
+       exposed by a scroll); only the parts of the frames inside it get drawn
+    """
+    if clip is None:
+        clip = painter.viewport()
+    top, bottom = clip.top(), clip.bottom() + 1
+    for frame in frames:
+        if y >= bottom: break
         frame_height = frame.rect().height()
-        if y + frame_height > 0: # don't draw something that won't even be visible
-            paint_frame(painter, frame, y)
+        if y + frame_height > top: # don't draw something that won't even be visible
+            paint_frame(painter, frame, y, clip)
         y += frame_height 
-        frames = frames[1:]
-
@@ -14,54 +14,188 @@
 from PyQt4 import QtGui, QtCore
 
 # Project imports
+from mangareader import bgloader, readahead, positions
 from mangareader.widgets import fstrip, mscroll, scrolling
 
+# how long (msec) the zoom level must stay still before we do a proper (smooth) scaling
+ZOOM_SETTLE_DELAY = 250 
+
+# scrolling input is collected and applied once per frame
+FRAME_INTERVAL = 16 # msec; about 60 frames per second
+SMOOTH_SCROLL_FRACTION = 0.3 # with smooth scrolling, the part of the pending distance we cover per frame
+FLING_FRICTION = 0.92 # the part of its speed a fling keeps from one frame to the next
+WINDOW_REFRESH_INTERVAL = 1000 # msec; how often an adaptive read-ahead window gets to shrink while we sit still
+
+class LoadNotifier(QtCore.QObject):
+    """ Carries "page loaded" notifications from the loader threads to the GUI 
+        thread, where it's safe to paint
+
+        The path goes through as the python object itself (not a QString), so it
+        comes out as the same byte string the page list has it under
+    """
+    def notify(self, path):
+        self.emit(QtCore.SIGNAL("pageLoaded(PyQt_PyObject)"), path)
+
 class MangaFrame(QtGui.QWidget):
-    def __init__(self, startdir):
+    def __init__(self, startdir, adaptive_read_ahead=False, position_store=None):
+        """ @param position_store: where we remember the reading position of each
+                manga; a PositionStore on the manga catalog by default
+        """
         QtGui.QWidget.__init__(self, None)
-        self.scroller = mscroll.MangaScroller(startdir)
+        self.adaptive_read_ahead = adaptive_read_ahead
+        if position_store is None:
+            position_store = positions.PositionStore()
+        self.positions = position_store
         # we use this to know to re-render when new pages are loaded!
+        self.load_notifier = LoadNotifier()
+        self.connect(self.load_notifier, QtCore.SIGNAL("pageLoaded(PyQt_PyObject)"), 
+                self.pageLoaded, QtCore.Qt.QueuedConnection)
+        self.scroller = self.new_scroller(startdir)
+        self.restore_position()
         self._zoom_factor = 100 # in percent
-        self.dirty = True
-
-        self.timer = QtCore.QTimer()
-        self.connect(self.timer, QtCore.SIGNAL("timeout()"), self.timerEvent)
-        self.timer.start(500) # number is msec
 
+        # while zooming, pages are scaled with a cheap transformation, and
+        # properly scaled once the zoom level stops changing
+        self.zooming = False
+        self.zoom_timer = QtCore.QTimer()
+        self.zoom_timer.setSingleShot(True)
+        self.connect(self.zoom_timer, QtCore.SIGNAL("timeout()"), self.zoomSettled)
+
+        # scrolling: input events only add to the pending distance (or the fling 
+        # speed); the frame timer moves the cursor and paints, at most once a frame
+        self.pending_scroll = 0
+        self.velocity = 0.0 # pixels per frame
+        self.smooth_scrolling = False
+        self.frame_timer = QtCore.QTimer()
+        self.frame_timer.setSingleShot(True)
+        self.connect(self.frame_timer, QtCore.SIGNAL("timeout()"), self.nextFrame)
+
+        # the adaptive read-ahead window grows while we scroll fast; it has to be
+        # asked again once we stop, or the extra pages would stay pinned
+        self.window_timer = QtCore.QTimer()
+        self.connect(self.window_timer, QtCore.SIGNAL("timeout()"), self.refreshWindow)
+        if self.adaptive_read_ahead:
+            self.window_timer.start(WINDOW_REFRESH_INTERVAL)
 
     def scrollDown(self, step=None):
-        self.scroller.scroll_down(step)
+        self.pending_scroll += step
+        self.schedule_frame()
     
     def scrollUp(self, step=None):
-        self.scroller.scroll_up(step)
+        self.scrollDown(-step)
+
+    def fling(self, velocity):
+        """Start kinetic scrolling at `velocity` (pixels per second); it slows down by itself"""
+        self.velocity = velocity * FRAME_INTERVAL / 1000.0
+        self.schedule_frame()
+
+    def stop_scrolling(self):
+        self.pending_scroll = 0
+        self.velocity = 0.0
+
+    def schedule_frame(self):
+        if not self.frame_timer.isActive():
+            self.frame_timer.start(FRAME_INTERVAL)
+
+    def nextFrame(self):
+        """Apply the scrolling collected since the last frame"""
+        amount = self.pending_scroll
+        if self.smooth_scrolling and abs(amount) > 1:
+            amount = int(amount * SMOOTH_SCROLL_FRACTION) or cmp(amount, 0)
+        self.pending_scroll -= amount
+        if self.velocity:
+            amount += int(round(self.velocity))
+            self.velocity *= FLING_FRICTION
+            if abs(self.velocity) < 0.5: self.velocity = 0.0
+        if amount:
+            moved = self.scroller.move_cursor(amount)
+            if moved != amount: # hit the start/end, or a page that's not ready
+                self.stop_scrolling()
+            if moved:
+                self.remember_position()
+            self.scroll_contents()
+        if self.pending_scroll or self.velocity:
+            self.schedule_frame()
+
+    def refreshWindow(self):
+        self.scroller.refresh_window()
+
+    def scroll_contents(self):
+        """ Shift what's already on screen by as much as the pages moved; Qt then only
+            asks us to paint the strip that got exposed
+        """
+        shift = self.scroller.take_shift()
+        if shift is None or self.zooming or abs(shift) >= self.height():
+            self.update()
+        elif shift:
+            self.scroll(0, shift)
 
     def paintEvent(self, event):
         painter = QtGui.QPainter()
         painter.begin(self)
         self.scroller.view_settings.set_max_width(painter.viewport().width())
         self.scroller.view_settings.set_zoom_level(self.zoom_factor)
+        self.scroller.view_settings.set_fast_scaling(self.zooming)
         try: 
-            self.scroller.paint_using(painter)
+            self.scroller.paint_using(painter, event.rect())
         except: 
             raise # for debug only
             print "error in painting"
         finally:
             painter.end()
 
-    # XXX: this is a hack to paint images than need to wait for loading
-    # TODO: replace with an image-loaded event
-    def timerEvent(self):
-        if self.scroller.dirty:
-            self.repaint()
+    def pageLoaded(self, path):
+        """A page got loaded (or rescaled) in the background; repaint it if it's visible"""
+        rect = self.scroller.page_rect(path, self.rect())
+        if rect is not None:
+            self.update(rect)
+
+    def new_scroller(self, path):
+        if self.adaptive_read_ahead:
+            workers = bgloader.thread_options["image_loader"]["workers"]
+            read_ahead = readahead.AdaptiveReadAhead(workers=workers)
+        else:
+            read_ahead = None # the default, fixed window
+        return mscroll.MangaScroller(path, on_page_loaded=self.load_notifier.notify, read_ahead=read_ahead)
+
+    def remember_position(self):
+        """Note where we are in the manga; it's written to disk a bit later"""
+        position = self.scroller.position()
+        if position is not None:
+            self.positions.record(self.scroller.root_path, *position)
+
+    def restore_position(self):
+        """Go back to where we were the last time we read this manga"""
+        if self.scroller.root_path is None: return
+        position = self.positions.lookup(self.scroller.root_path)
+        if position is not None:
+            self.scroller.restore_position(*position)
 
     def change_manga(self, path):
-        # TODO remember where we were last time we were reading this mange
-        # and restore to the same place
-        self.scroller = mscroll.MangaScroller(path)
-        self.repaint()
+        self.stop_scrolling()
+        self.remember_position()
+        self.scroller.close()
+        self.scroller = self.new_scroller(path)
+        self.restore_position()
+        self.update()
+
+    def close_manga(self):
+        """Called when we're about to quit"""
+        self.remember_position()
+        self.positions.close()
+        self.scroller.close()
+
+    def print_stats(self):
+        """Tell how the caches are doing, for tuning"""
+        if not hasattr(self.scroller, 'cursor'): return # empty manga
+        print "image cache:", self.scroller.page_list.img_cache.stats()
+        print "pixmap conversions: %.1f/sec (%d total)" % (fstrip.conversions.rate(), fstrip.conversions.total)
 
     def change_chapter(self, path):
+        self.stop_scrolling()
         self.scroller.change_chapter(path)
+        self.remember_position()
+        self.update()
 
     def zoom_in(self, amount):
         self.set_zoom_factor(self.zoom_factor + amount)
@@ -79,5 +213,11 @@ class MangaFrame(QtGui.QWidget):
     def set_zoom_factor(self, value):
         if value < 70: return # don't zoom out too much
         self._zoom_factor = value
-        self.dirty = True
+        self.zooming = True
+        self.zoom_timer.start(ZOOM_SETTLE_DELAY) # restarts the countdown if already running
+        self.update()
+
+    def zoomSettled(self):
+        self.zooming = False
+        self.update()
 
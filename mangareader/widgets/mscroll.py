@@ -15,39 +15,148 @@
         list of images as the user scrolls up/down
 """    
 
-import itertools
+import itertools, threading, time
+from collections import OrderedDict, deque
 
 from PyQt4 import QtGui, QtCore
 
-from mangareader import fetch
-from mangareader.widgets import fstrip
+from mangareader import fetch, imgsize
+from mangareader.readahead import StaticReadAhead
+from mangareader.widgets import fstrip, procdecode
 from mangareader.tree.walk import step as walk_step
 from mangareader.tree.view import context as view_context
-from mangareader.bgloader import queue_image_loader
+from mangareader.bgloader import (
+            queue_image_loader, reprioritize_image_loaders, cancel_image_loaders)
 from mangareader.widgets.scrolling import (
-            ViewSettings, PageCursor, get_loaded_context)
+            ViewSettings, PageCursor, HeightList, scan_loaded_range, get_loaded_range, 
+            load_priority, FORWARD)
 
 import os.path
 
-def scaled_image(image, new_width):
-    return image.scaledToWidth(new_width, QtCore.Qt.SmoothTransformation)
+DEFAULT_CACHE_BUDGET = 384 * 1024 * 1024 # bytes of decoded images
+DEFAULT_SCALED_BUDGET = 128 * 1024 * 1024 # bytes of scaled images, for all pages together
+SCALED_WIDTHS_PER_PAGE = 2 # how many display widths we remember per page
+# when the edge of the window gets this close to the end of its chapter, we start
+# listing the next chapter in the background
+PREFETCH_PAGES = 5
 
-def get_desired_display_width(image, view_settings=None):    
+def scaled_height(width, height, new_width):
+    """The height of an image of size (width, height) scaled to new_width"""
+    if width <= 0: return 0 # broken image
+    return max(1, int(round(height * float(new_width) / width)))
+
+def scaled_image(image, new_width, new_height=None, fast=False):
+    """Scale image to new_width, keeping the aspect ratio (unless new_height is given)
+
+        @param fast: use a cheap transformation (for previews)
+    """
+    mode = QtCore.Qt.FastTransformation if fast else QtCore.Qt.SmoothTransformation
+    if new_height is None:
+        new_height = scaled_height(image.width(), image.height(), new_width)
+    return image.scaled(new_width, new_height, QtCore.Qt.IgnoreAspectRatio, mode)
+
+def get_desired_display_width(width, view_settings=None):    
+    """The display width of an image that's `width` pixels wide originally"""
     if view_settings is None: 
         view_settings = ViewSettings() # use the defaults
-    return view_settings.transformed_width(image.width())
+    return int(view_settings.transformed_width(width))
+
+def image_bytes(image):
+    """How much RAM a decoded image takes"""
+    if image is None: return 0
+    return image.width() * image.height() * image.depth() // 8
+
+class ScaledFrameCache(object):
+    """Scaled versions of page images, keyed by (path, display width)
+
+        Every zoom step produces a new display width, so we only keep the last
+        few widths for each page, and evict the least recently used images
+        (across all pages) when over `byte_budget`.
+    """
+    def __init__(self, byte_budget=DEFAULT_SCALED_BUDGET, widths_per_page=SCALED_WIDTHS_PER_PAGE):
+        self.byte_budget = byte_budget
+        self.widths_per_page = widths_per_page
+        self.map = OrderedDict() # (path, width) -> image; least recently used first
+        self.widths = {} # path -> list of widths; most recent last
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, width):
+        with self.lock:
+            key = (path, width)
+            if not self.map.has_key(key): return None
+            image = self.map[key] = self.map.pop(key)
+            widths = self.widths[path]
+            widths.remove(width)
+            widths.append(width)
+            return image
+
+    def put(self, path, width, image):
+        with self.lock:
+            if self.map.has_key((path, width)):
+                self._remove(path, width)
+            self.map[(path, width)] = image
+            self.widths.setdefault(path, []).append(width)
+            self.bytes += image_bytes(image)
+            while len(self.widths[path]) > self.widths_per_page:
+                self._remove(path, self.widths[path][0])
+            while self.bytes > self.byte_budget and len(self.map) > 1:
+                old_path, old_width = self.map.iterkeys().next()
+                self._remove(old_path, old_width)
+
+    def nearest(self, path, width):
+        """The cached image for path whose width is closest to `width`, or None"""
+        with self.lock:
+            widths = self.widths.get(path)
+            if not widths: return None
+            best = min(widths, key=lambda w: abs(w - width))
+            return self.map[(path, best)]
+
+    def discard(self, path):
+        """Forget all scaled images of path"""
+        with self.lock:
+            for width in list(self.widths.get(path, [])):
+                self._remove(path, width)
+
+    def page_bytes(self, path):
+        with self.lock:
+            return sum(image_bytes(self.map[(path, width)]) for width in self.widths.get(path, []))
+
+    def _remove(self, path, width):
+        image = self.map.pop((path, width))
+        self.bytes -= image_bytes(image)
+        self.widths[path].remove(width)
+        if not self.widths[path]:
+            del self.widths[path]
+
+scaled_frames = ScaledFrameCache()
 
 class Page(object):
-    def __init__(self, node):
+    """
+        @param on_loaded: optional function(page), called (from the loader thread) 
+            when the page is done loading, and whenever a new scaled version is ready
+    """
+    def __init__(self, node, on_loaded=None):
         self.path = node.path #XXX
+        self.on_loaded = on_loaded
         self.loading = 0  # 0 = not loaded; 1 = loading; 2 = loaded
-        self.frame = None # the QImage object
-        self.scaled = {}  # a mapping from percentage to a scaled QImage 
+        self.size = None # (width, height) of the original image
+        self.frame = None # the QImage object; might be decoded smaller than `size`
+        self.preview = None # (width, image): quick and dirty scaled image, used while zooming
+        self.scaling_width = None # the display width being scaled in the background, if any
+        self.decode_seconds = None # how long the load took; the page list takes it for the read-ahead policy
+        self.pixmap = None # fstrip.TiledPixmap of the last frame we drew; GUI thread only
 
     def is_loaded(self): 
         return self.loading == 2
 
-    def load(self):
+    def has_size(self):
+        """Do we know the page size? We can tell from the image header, without loading it"""
+        if self.size is None:
+            self.size = imgsize.image_size(self.path) # cached, and only reads the header
+        return self.size is not None
+
+    def load(self, priority=0, view_settings=None):
         """
             Load page in the background, if not already loaded.
 
@@ -55,46 +164,142 @@ class Page(object):
 
             But it's actually not just a thread, it puts the loader in a queue, 
             among with other loader functions that are waiting to be loaded.
+            A small pool of workers pulls from that queue, so several pages
+            can be decoded at the same time. The queue is ordered by `priority`
+            (lower loads first), and pending loads are tagged with the page path
+            so they can be re-prioritized or cancelled later.
 
-            We do this so that images are loaded in order, not randomly (or depending on which is faster to load/smaller in size)
+            The image is decoded straight to the display width for
+            `view_settings` (when that's smaller than the original), so big
+            scans never take their full size in RAM unless zooming needs it.
 
             We'll know when the loader is done because it sets `self.loading = 2`
         """
         if self.loading > 0: return
+        load_image = procdecode.decoder_for("image_loader")
         def image_loader(): # this will run in a background thread
-            _frame = fstrip.load_image(self.path)
+            start = time.time()
+            size = self.size or imgsize.image_size(self.path) or fstrip.image_size(self.path)
+            if size is None or view_settings is None:
+                _frame = load_image(self.path)
+                if size is None:
+                    size = (_frame.width(), _frame.height())
+                    imgsize.remember_size(self.path, size)
+                self.size = size
+            else:
+                self.size = size
+                display_width = self.display_width(view_settings)
+                _frame = load_image(self.path, display_width, self.display_height(display_width))
+                self._store_scaled(_frame, display_width) # only if zoomed past the original size
             self.frame = _frame
+            self.decode_seconds = time.time() - start
             self._set_loading_status('done')
+            if self.on_loaded is not None:
+                self.on_loaded(self)
+        def cancelled(): # the load was dropped from the queue before it started
+            self._set_loading_status('none')
         self._set_loading_status('loading')
-        queue_image_loader(image_loader)
+        queue_image_loader(image_loader, priority, tag=self.path, on_cancel=cancelled)
 
     def _set_loading_status(self, status):
         self.loading = {
+                'none':0,
                 'loading':1,
                 'done':2
             }.get(status)
 
+    def byte_size(self):
+        """RAM taken by the decoded image and its scaled versions"""
+        return image_bytes(self.frame) + scaled_frames.page_bytes(self.path)
+
     @property
     def height(self):
         return self.get_height()
 
+    def display_width(self, view_settings=None):
+        return get_desired_display_width(self.size[0], view_settings)
+
+    def display_height(self, display_width):
+        return scaled_height(self.size[0], self.size[1], display_width)
+
     def get_height(self, view_settings=None):
-        if not self.is_loaded:
+        if not self.has_size():
             return None
-        return self.get_frame(view_settings).rect().height()
-        
+        return self.display_height(self.display_width(view_settings))
 
     def get_frame(self, view_settings=None):
-        if not self.is_loaded:
+        if not self.is_loaded():
             return None
         # The view settings determine the size of the image
-        # To be efficient, we use a dictionary to cache resized images
+        # To be efficient, we use a cache of resized images
         # we use the display width as the key, because that's what we're 
         # _semantically_ interested in when displaying the image
-        display_width = get_desired_display_width(self.frame, view_settings)
-        if not self.scaled.has_key(display_width):
-            self.scaled[display_width] = scaled_image(self.frame, new_width=display_width)
-        return self.scaled[display_width]
+        display_width = self.display_width(view_settings)
+        if display_width == self.frame.width():
+            return self.frame
+        frame = scaled_frames.get(self.path, display_width)
+        if frame is not None:
+            self.preview = None # not needed anymore
+            return frame
+        # never scale smoothly while painting: ask the loader for it, and
+        # draw a quick preview until it's ready
+        if view_settings is None or not view_settings.fast_scaling:
+            self.request_scaled(display_width)
+        return self.get_preview(display_width)
+
+    def get_display_frame(self, view_settings=None):
+        """ Like get_frame, but a final frame (not a preview) comes converted to 
+            pixmaps, ready for blitting. The conversion happens once per frame, 
+            i.e. once per page per zoom level
+
+            @note: call from the GUI thread only
+        """
+        frame = self.get_frame(view_settings)
+        if frame is None: return None
+        if self.preview is not None and frame is self.preview[1]:
+            return frame # changes with every zoom step; not worth converting
+        if self.pixmap is None or self.pixmap.source_key != frame.cacheKey():
+            self.pixmap = fstrip.TiledPixmap(frame)
+        return self.pixmap
+
+    def drop_pixmap(self):
+        self.pixmap = None
+
+    def request_scaled(self, display_width, priority=0):
+        """Scale the image to display_width in the background"""
+        if self.scaling_width == display_width: return # already on it
+        self.scaling_width = display_width
+        load_image = procdecode.decoder_for("image_loader")
+        def scaler(): # this will run in a background thread
+            frame = self.frame
+            if frame.width() < min(display_width, self.size[0]): 
+                # zoomed in past the resolution we decoded at; go back to the file
+                frame = load_image(self.path, display_width, self.display_height(display_width))
+                self.frame = frame
+            self._store_scaled(frame, display_width)
+            if self.scaling_width == display_width:
+                self.scaling_width = None
+            if self.on_loaded is not None:
+                self.on_loaded(self)
+        def cancelled():
+            if self.scaling_width == display_width:
+                self.scaling_width = None
+        queue_image_loader(scaler, priority, tag=self.path, on_cancel=cancelled)
+
+    def _store_scaled(self, frame, display_width):
+        if display_width == frame.width(): return
+        display_height = self.display_height(display_width)
+        scaled_frames.put(self.path, display_width, scaled_image(frame, display_width, display_height))
+
+    def get_preview(self, display_width):
+        """A cheap scaled image, made from the closest image we already have"""
+        if self.preview is None or self.preview[0] != display_width:
+            source = scaled_frames.nearest(self.path, display_width)
+            if source is None or source.width() < display_width:
+                source = self.frame
+            preview = scaled_image(source, display_width, self.display_height(display_width), fast=True)
+            self.preview = (display_width, preview)
+        return self.preview[1]
 
 class ImageCache(object):
     """A mapping from image path to page object, with caching
@@ -102,52 +307,130 @@ class ImageCache(object):
         usage: first, initialize a cache
                - you can add paths to the cache, and the images will be loaded
                - you can remove paths (and the images will be removed)
-               - you can reset the cache with a list of paths, any loaded image not 
-                 in the new list will be removed, and new image will be loaded
+               - you can reset the cache with a list of paths; the pages in the list
+                 are pinned (never evicted), and the rest are kept around in least
+                 recently used order until the decoded images exceed `byte_budget`
 
-        TODO consider using the image width as an additional key
+        Pages outside the window are kept as long as there's room for them, so
+        scrolling back and forth across the window boundary doesn't re-decode them.
 
+        @param byte_budget: how much RAM (in bytes) the decoded images may take
+        @param on_page_loaded: passed to every Page as its `on_loaded`
         @note: the paths we deal with should always be absolute paths
     """
-    def __init__(self):
-        self.map = {}
+    def __init__(self, byte_budget=DEFAULT_CACHE_BUDGET, on_page_loaded=None):
+        self.on_page_loaded = on_page_loaded
+        self.map = OrderedDict() # least recently used first
+        self.pinned = set()
+        self.byte_budget = byte_budget
+        self.hits = 0 # pages asked for display that were decoded already
+        self.misses = 0 # ... and those we had to show a placeholder for
+        self.evictions = 0
 
     def get(self, path):
         return self.map[path]
 
+    def request(self, path):
+        """The page at path, which is about to be displayed; counts as a hit if it's loaded"""
+        page = self.map[path]
+        if page.is_loaded():
+            self.hits += 1
+        else:
+            self.misses += 1
+        return page
+
     def contains(self, path):
         return self.map.has_key(path)
 
     def add(self, node):
         path = node.path
-        if self.contains(path): return
-        page = Page(node) #XXX
+        if self.contains(path):
+            self.map[path] = self.map.pop(path) # mark as recently used
+            return
+        page = Page(node, self.on_page_loaded) #XXX
         self.map[path] = page
         # page.load(max_width) # don't load yet ..
     def remove(self, path):
+        # don't waste the loader's time on pages we're throwing away
+        cancel_image_loaders([path])
+        scaled_frames.discard(path)
         del self.map[path]
     def reset(self, node_list):
-        """remove paths not in path_list, load pages not already loaded"""
-        path_list = [node.path for node in node_list]
-        dead_paths = set(self.map.keys()) - set(path_list)
+        """pin the pages in node_list (adding any missing ones), evict old pages if over budget"""
+        for path in self.pinned.difference(node.path for node in node_list):
+            self.unpin(path)
+        self.pinned = set(node.path for node in node_list)
         for node in node_list:
             self.add(node) #XXX
-        for path in dead_paths:
-            self.remove(path) #XXX
+        self.trim()
+    def pin(self, node):
+        """add node's page if missing, and keep it from being evicted"""
+        self.add(node)
+        self.pinned.add(node.path)
+    def unpin(self, path):
+        """let path's page be evicted (next time we `trim`); it won't be drawn for a while, so drop its pixmap"""
+        self.pinned.discard(path)
+        if self.contains(path):
+            self.map[path].drop_pixmap()
+    def byte_size(self):
+        return sum(page.byte_size() for page in self.map.itervalues())
+    def trim(self):
+        """Evict unpinned pages, least recently used first, until we're under budget
+
+            Pinned pages are never evicted, even if they alone exceed the budget.
+            Unpinned pages that have no image hold nothing worth keeping, so they go too.
+        """
+        total = self.byte_size()
+        for path, page in self.map.items():
+            if path in self.pinned: continue
+            size = page.byte_size()
+            if page.is_loaded() and total <= self.byte_budget: continue
+            self.remove(path)
+            self.evictions += 1
+            total -= size
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                pages=len(self.map), bytes=self.byte_size(), budget=self.byte_budget)
 
 class PageList(object):
-    def __init__(self, root):
+    def __init__(self, root, cache_budget=DEFAULT_CACHE_BUDGET, items_before=3, items_after=10, 
+            on_page_loaded=None, read_ahead=None):
         """ Partial directory view that can be moved around (can't be resized
             yet, though that might be useful)
 
             This works internally by storing a node list an using an image
             cache to get the image corresponding to a certain node
 
+            The window slides along with the cursor: when the cursor moves to
+            another page, we only step the tree at the edges of the window
+            for the pages that come in, and drop the ones that go out.
+
             @param root: the manga root directory
+            @param cache_budget: bytes of decoded images to keep in RAM
+            @param items_before, items_after: how many pages to keep around the cursor,
+                when there's no read_ahead policy
+            @param on_page_loaded: optional function(path), called from the loader
+                threads when a page is loaded (or rescaled)
+            @param read_ahead: optional policy (see the readahead module) that decides
+                how many pages to keep around the cursor, as the cursor moves
         """
-        self.tree = fetch.DirTree(root)
-        self.nodes = []
-        self.img_cache = ImageCache()
+        self.tree = fetch.DirTree(root, indexed=True)
+        self.nodes = deque()
+        if read_ahead is None:
+            read_ahead = StaticReadAhead(items_before, items_after)
+        self.read_ahead = read_ahead
+        self.items_before, self.items_after = read_ahead.window()
+        self.center = 0 # index of the cursor page the window was last built around
+        self.at_start = self.at_end = False # did we hit the start/end of the manga?
+        self.img_cache = ImageCache(cache_budget, on_page_loaded=self._page_loaded)
+        self.base = 0 # position of nodes[0]; positions keep counting as the window slides
+        self.positions = {} # maps paths in the window to their position
+        self._heights = HeightList() # parallel to self.nodes
+        self.unsized = set() # paths of pages we didn't know the height of when we added them
+        self.loaded_events = deque() # paths of pages that finished loading
+        self.on_page_loaded = on_page_loaded
+        self._run = None # cached (first, end) positions of the sized run around the cursor
+        self._priority_key = None
         first_node = walk_step(self.tree, self.tree.root)
         if first_node is None:
             raise EmptyMangaException
@@ -157,6 +440,10 @@ class PageList(object):
         """fake list of Page objects"""
         return self.img_cache.get(self.page_path_at(index))
 
+    def display_page_at(self, index):
+        """Like page_at, for a page we're about to draw (counted in the cache stats)"""
+        return self.img_cache.request(self.page_path_at(index))
+
     def page_path_at(self, index):
         return self.nodes[index].path
 
@@ -171,31 +458,222 @@ class PageList(object):
     def reset_to_path(self, path):
         chapter_node = self.tree.get_node(path)
         first_node = walk_step(self.tree, chapter_node)
-        return self._reset_window_to_node(first_node)
+        index = self._reset_window_to_node(first_node)
+        self.reprioritize(index)
+        return index
+
+    def reset_to_page(self, path):
+        """ Move the window to the page at path (relative to the root), straight
+            from the tree, without walking there
+
+            @returns: the index of the page, or None if it's not there anymore
+        """
+        try:
+            node = self.tree.get_node(path)
+        except fetch.InvalidEntryName:
+            return None
+        if node is None or node.isdir: return None
+        index = self._reset_window_to_node(node)
+        self.reprioritize(index)
+        return index
 
     def _reset_window_to_node(self, node):
-        """resets the view/window around the current file path"""
+        """resets the view/window around the current file path (from scratch)"""
         if node is None: node = self.nodes[self.index]
-        list = view_context(self.tree, node)
+        list = view_context(self.tree, node, self.items_before, self.items_after)
         new_index = list.index(node)
-        self.nodes = list
+        self.nodes = deque(list)
+        self.center = new_index
+        self.at_start = new_index < self.items_before
+        self.at_end = len(list) - 1 - new_index < self.items_after
         # also reset the image cache; this is essential to free up some ram
         self.img_cache.reset(self.nodes) #XXX
+        self.base = 0
+        self.positions = dict((node.path, i) for i, node in enumerate(self.nodes))
+        self.unsized = set()
+        self._heights = HeightList(self._page_height(node) for node in self.nodes)
+        self._run = None
         return new_index
 
-    def reset_window(self, index):
-        return self._reset_window_to_node(self.nodes[index])
+    def _slide_window(self, index):
+        """ Move the window so that it's centered on `index`, by only adding and
+            removing nodes at the edges
+
+            @returns: the new index of the node at `index`
+        """
+        nodes, cache = self.nodes, self.img_cache
+        heights = self._heights
+        while index > self.items_before: # too many before
+            self._forget(nodes.popleft())
+            heights.popleft()
+            self.base += 1
+            index -= 1
+            self.at_start = False
+        while index < self.items_before and not self.at_start: # too few before
+            node = walk_step(self.tree, nodes[0], 'prev')
+            if node is None:
+                self.at_start = True
+                break
+            nodes.appendleft(node)
+            self.base -= 1
+            self.positions[node.path] = self.base
+            cache.pin(node)
+            heights.prepend(self._page_height(node))
+            index += 1
+        while len(nodes) - 1 - index > self.items_after: # too many after
+            self._forget(nodes.pop())
+            heights.pop()
+            self.at_end = False
+        while len(nodes) - 1 - index < self.items_after and not self.at_end: # too few after
+            node = walk_step(self.tree, nodes[-1], 'next')
+            if node is None:
+                self.at_end = True
+                break
+            nodes.append(node)
+            self.positions[node.path] = self.base + len(nodes) - 1
+            cache.pin(node)
+            heights.append(self._page_height(node))
+        cache.trim()
+        self.center = index
+        self._run = None
+        return index
+
+    def index_of(self, path):
+        """The index of the page at path in the window, or None"""
+        position = self.positions.get(path)
+        if position is None: return None
+        return position - self.base
+
+    def _page_height(self, node):
+        height = self.img_cache.get(node.path).get_height()
+        if height is None:
+            self.unsized.add(node.path)
+            return 0
+        return height
+
+    def _forget(self, node):
+        """node is out of the window"""
+        self.img_cache.unpin(node.path)
+        self.unsized.discard(node.path)
+        del self.positions[node.path]
+
+    def _page_loaded(self, page):
+        """Called from the loader threads when a page is done loading"""
+        seconds, page.decode_seconds = page.decode_seconds, None
+        if seconds is not None: # a decode, not a rescale
+            self.read_ahead.observe_decode(seconds)
+        self.loaded_events.append(page.path) # deque.append is thread safe
+        if self.on_page_loaded is not None:
+            self.on_page_loaded(page.path)
+
+    def _process_loaded_events(self):
+        """Pages that we didn't know the size of might know it now that they're loaded"""
+        while self.loaded_events:
+            path = self.loaded_events.popleft()
+            if path not in self.unsized: continue
+            index = self.index_of(path)
+            height = self.page_at(index).get_height()
+            if height is not None:
+                self._heights.set_height(index, height)
+                self.unsized.discard(path)
+                self._run = None
+
+    def heights(self):
+        """The HeightList of the window, kept up to date as the window slides"""
+        self._process_loaded_events()
+        return self._heights
+
+    def loaded_range(self, index):
+        """ The run of pages around index whose size we know, as (first, end)
+            (end is exclusive). 
+
+            Usually all of them are, so this is O(1); otherwise the run is 
+            cached until the window slides or a page finds out its size.
+        """
+        self._process_loaded_events()
+        if not self.unsized:
+            return 0, len(self.nodes)
+        position = self.base + index
+        if self._run is None or not (self._run[0] <= position < self._run[1]):
+            first, end = scan_loaded_range(self, index)
+            if first == end: return first, end # don't cache empty runs
+            self._run = (self.base + first, self.base + end)
+        return self._run[0] - self.base, self._run[1] - self.base
+
+    def close(self):
+        """Done with this manga; remember what we learned about it"""
+        self.tree.save_index()
+
+    def reset_window(self, index, direction=FORWARD):
+        """ Follow the cursor to `index`. The window is also resized when the read-ahead
+            policy changed its mind while the cursor stayed on the same page (e.g. the
+            reader stopped, so fewer pages need to be kept ahead)
+
+            @returns: the new index of the cursor page
+        """
+        if index != self.center:
+            self.read_ahead.observe_move(index - self.center)
+        window = self.read_ahead.window()
+        if index != self.center or window != (self.items_before, self.items_after):
+            self.items_before, self.items_after = window
+            index = self._slide_window(index)
+            self._prefetch_chapter(direction)
+        self.reprioritize(index, direction)
+        return index
+
+    def _prefetch_chapter(self, direction):
+        """ If the window is about to run into the next (or previous) chapter, get the
+            chapter listed in the background, before the window needs it
+        """
+        if (self.at_end if direction == FORWARD else self.at_start): return
+        edge = self.nodes[-1] if direction == FORWARD else self.nodes[0]
+        chapter = self.tree.parent(edge)
+        if direction == FORWARD:
+            remaining = len(chapter.ls) - 1 - edge.position
+        else:
+            remaining = edge.position
+        if remaining < PREFETCH_PAGES:
+            self.tree.prefetch_sibling_chapter(edge, direction)
+
+    def load_pages(self, cursor_index, direction=FORWARD, view_settings=None):
+        """Queue loading of all the pages in the window, nearest to the cursor first"""
+        for i in range(self.length()):
+            priority = load_priority(i, cursor_index, direction)
+            self.page_at(i).load(priority, view_settings) # this is non-blocking
+
+    def reprioritize(self, cursor_index, direction=FORWARD):
+        """Re-order pending page loads according to the new cursor position"""
+        key = (self.page_path_at(cursor_index), direction)
+        if key == self._priority_key: return # cursor is still on the same page
+        self._priority_key = key
+        def priority(path):
+            index = self.index_of(path)
+            if index is None: return None # not ours anymore
+            return load_priority(index, cursor_index, direction)
+        reprioritize_image_loaders(priority)
 
 class EmptyPageList(object):
     def __init__(self): pass
     def length(self): return 0
     __length__ = length
-    def reset_window(self, index): pass
+    def reset_window(self, index, direction=FORWARD): pass
+    def loaded_range(self, index): return index, index
+    def index_of(self, path): return None
+    def close(self): pass
 
 class MangaScroller(object):
-    def __init__(self, root, view_settings=None):
+    """
+        @param on_page_loaded: optional function(path), called from the loader
+            threads when a page is loaded (or rescaled)
+        @param read_ahead: optional read-ahead policy for the page list
+    """
+    def __init__(self, root, view_settings=None, on_page_loaded=None, read_ahead=None):
+        self.painted_range = (0, 0) # (first, end) indices of the pages drawn in the last paint
+        self.painted_anchor = None # (path, y) of the first page drawn in the last paint
+        self.root_path = None # the manga's real path, once we know it's not empty
         try: 
-            self.page_list = PageList(root)
+            self.page_list = PageList(root, on_page_loaded=on_page_loaded, read_ahead=read_ahead)
+            self.root_path = self.page_list.tree.root_path
             if view_settings is None:
                 view_settings = ViewSettings()
             self.view_settings = view_settings
@@ -203,45 +681,149 @@ class MangaScroller(object):
         except EmptyMangaException: 
             print "Warning: empty manga"
             self.page_list = EmptyPageList()
-        # TODO: use the dirty attribute after paint to indicate
-        # if a refresh is still needed
-        self.dirty = True 
+
+    def close(self):
+        self.page_list.close()
 
     def change_chapter(self, path):
         self.cursor.index = self.page_list.reset_to_path(path)
         self.cursor.pixel = 0
+        self.cursor.direction = FORWARD
+        self.painted_range = (0, 0)
+        self.painted_anchor = None # what's on screen is of no use now; paint it all again
+
+    def position(self):
+        """ (path of the page at the cursor relative to the manga root, pixel offset
+            into it), or None for an empty manga
+        """
+        if not hasattr(self, 'cursor'): return None
+        path = self.page_list.tree.relpath(self.page_list.page_path_at(self.cursor.index))
+        return path, self.cursor.pixel
+
+    def restore_position(self, path, pixel):
+        """ Put the cursor back where `position` said it was
+
+            @param path: path of the page, relative to the manga root
+            @returns: whether the page is still there
+        """
+        if not hasattr(self, 'cursor'): return False
+        index = self.page_list.reset_to_page(path)
+        if index is None: return False
+        self.cursor.index = index
+        height = self.page_list.page_at(index).get_height()
+        if height: pixel = min(pixel, height - 1) # the page got shorter?
+        self.cursor.pixel = max(0, pixel)
+        self.cursor.direction = FORWARD
+        return True
 
     def scroll_down(self, step=100):
-        self.move_cursor(step)
+        return self.move_cursor(step)
     
     def scroll_up(self, step=100):
-        self.move_cursor(-step)
+        return -self.move_cursor(-step)
 
     def move_cursor(self, amount):
-        self.cursor.move(amount)
+        """@returns: the amount actually moved"""
+        return self.cursor.move(amount)
 
-    # TODO: This will need a big (good :) rewrite!
-    # TODO: should mark whether or not some space is left unrendered so that we
-    # know when we need to render images when they load
-    def paint_using(self, painter):
+    def refresh_window(self):
+        """Let the page window shrink (or grow) while the cursor sits still"""
+        if not hasattr(self, 'cursor'): return
+        self.cursor.index = self.page_list.reset_window(self.cursor.index, self.cursor.direction)
+
+    def page_rect(self, path, viewport):
+        """ The area of the viewport covered by the page at path, or None if it's
+            not visible. If the page wasn't drawn last time (we didn't know its 
+            size), the area extends to the bottom, since everything after it moved
+
+            @param viewport: QRect of the widget we paint on
+        """
+        index = self.page_list.index_of(path)
+        if index is None or index < self.cursor.index: return None
+        cursor_page = self.page_list.page_at(self.cursor.index)
+        if not cursor_page.has_size(): return viewport
+        y = -transformed_y_coord(self.view_settings, cursor_page, self.cursor.pixel)
+        for i in range(self.cursor.index, index):
+            if y >= viewport.height(): return None
+            height = self.page_list.page_at(i).get_height(self.view_settings)
+            if height is None: return None # the layout stops before this page
+            y += height
+        if y >= viewport.height(): return None
+        first, end = self.painted_range
+        height = self.page_list.page_at(index).get_height(self.view_settings)
+        if height is None or not first <= index < end:
+            height = viewport.height() - y
+        return QtCore.QRect(0, y, viewport.width(), height)
+
+    def take_shift(self):
+        """ How far (in screen pixels, down is positive) the pages on screen moved 
+            since they were painted, so the caller can scroll the painted pixels 
+            instead of painting everything again. 
+            
+            The result is taken into account, so calling this again right away gives 0
+
+            @returns: the shift, or None if we can't tell (e.g. the page we painted
+                first is out of the window now); then everything needs painting
+        """
+        if self.painted_anchor is None: return None
+        path, painted_y = self.painted_anchor
+        anchor = self.page_list.index_of(path)
+        if anchor is None: return None
+        cursor_page = self.page_list.page_at(self.cursor.index)
+        if not cursor_page.has_size(): return None
+        y = -transformed_y_coord(self.view_settings, cursor_page, self.cursor.pixel)
+        if anchor >= self.cursor.index:
+            indices, sign = range(self.cursor.index, anchor), 1
+        else:
+            indices, sign = range(anchor, self.cursor.index), -1
+        for i in indices:
+            height = self.page_list.page_at(i).get_height(self.view_settings)
+            if height is None: return None
+            y += sign * height
+        self.painted_anchor = (path, y)
+        return y - painted_y
+
+    def paint_using(self, painter, clip=None):
         """
             Render scroller using painter
 
+            Pages are laid out from the cursor down, until the viewport is full or we
+            reach a page whose size we don't know yet
+
             @param painter: qt painter
+            @param clip: optional QRect of the area that needs painting
         """
         # First, load any unloaded image
-        for i in range(self.page_list.length()):
-            self.page_list.page_at(i).load() # this is non-blocking
-        findex, loaded = get_loaded_context(self.page_list, self.cursor.index)
-        index = self.cursor.index - findex
-        limit = index + 3 # TEMP
-        pages = loaded[index:limit]
-        frames = [p.get_frame(self.view_settings) for p in pages]
-        if len(frames) == 0: return 0
+        self.page_list.load_pages(self.cursor.index, self.cursor.direction, self.view_settings)
+        index = self.cursor.index
+        findex, end = get_loaded_range(self.page_list, index)
+        if index >= end: 
+            self.painted_range = (index, index)
+            self.painted_anchor = None
+            return 0
         # transorming the image according to view_settings
-        y = -transformed_y_coord(self.view_settings, pages[0], self.cursor.pixel)
-        fstrip.paint_frames(painter, frames, y)
-        # return len(frames) 
+        y = -transformed_y_coord(self.view_settings, self.page_list.page_at(index), self.cursor.pixel)
+        viewport_height = painter.viewport().height()
+        pages = []
+        bottom = y
+        for i in range(index, end):
+            if bottom >= viewport_height: break
+            page = self.page_list.display_page_at(i)
+            pages.append(page)
+            bottom += page.get_height(self.view_settings)
+        frames = [frame_or_placeholder(p, self.view_settings) for p in pages]
+        self.painted_range = (index, index + len(frames))
+        self.painted_anchor = (pages[0].path, y)
+        fstrip.paint_frames(painter, frames, y, clip)
+        return len(frames)
+
+def frame_or_placeholder(page, view_settings):
+    """The frame to draw for page; a blank one of the right size if it's not loaded yet"""
+    frame = page.get_display_frame(view_settings)
+    if frame is None:
+        width = page.display_width(view_settings)
+        frame = fstrip.Placeholder(width, page.display_height(width))
+    return frame
 
 def transformed_y_coord(view_settings, page, y):
     original_height = page.get_height()
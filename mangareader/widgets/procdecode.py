@@ -0,0 +1,78 @@
+"""
+    Author: Hasen "hasenj" il Judy
+    License: GPL v2
+
+    Decode pictures in worker processes, to get around the GIL when there are lots
+    of them to decode.
+
+    The worker process decodes the picture (same as fstrip.load_image), and hands
+    the raw pixels back through shared memory (see mangareader.sharedmem), instead
+    of pickling them through a pipe; here they're copied once into a QImage.
+
+    Which kind of job decodes where is up to bgloader.set_job_backend; use
+    `decoder_for` to get the right load_image function.
+"""
+
+import ctypes, sip
+
+from PyQt4 import QtGui
+
+from mangareader import bgloader, sharedmem
+from mangareader.widgets import fstrip
+
+# formats we can hand over as they are: 32 bits per pixel, no color table
+DIRECT_FORMATS = (QtGui.QImage.Format_RGB32, QtGui.QImage.Format_ARGB32,
+        QtGui.QImage.Format_ARGB32_Premultiplied)
+
+def decode_job(image_path, width, height):
+    """ This runs in a worker process: decode the picture into shared memory
+
+        @returns: (shared name, width, height, bytes per line, format), or None if
+        the picture can't be handed over this way (e.g. it had to be loaded in tiles)
+    """
+    image = fstrip.load_image(image_path, width, height)
+    if isinstance(image, fstrip.TiledImage) or image.isNull():
+        return None
+    if image.format() not in DIRECT_FORMATS:
+        if image.hasAlphaChannel():
+            image = image.convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+        else:
+            image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+    name = sharedmem.export(image.constBits().asstring(image.byteCount()))
+    return name, image.width(), image.height(), image.bytesPerLine(), int(image.format())
+
+def wrap_pixels(name, width, height, bytes_per_line, format):
+    """ A QImage of the pixels a worker left in shared memory.
+
+        The pixels are copied once out of the mapping, and the mapping is closed
+        right away: a QImage over memory it doesn't own would be unsafe to hand
+        out, since Qt keeps implicitly shared copies of images (in pixmaps, queued
+        signals...) that can outlive the python object keeping the memory alive.
+    """
+    pixels = sharedmem.attach(name)
+    try:
+        anchor = ctypes.c_char.from_buffer(pixels)
+        shared = QtGui.QImage(sip.voidptr(ctypes.addressof(anchor)), width, height,
+                bytes_per_line, QtGui.QImage.Format(format))
+        image = shared.copy() # detached: owns its pixels
+        del shared, anchor
+    finally:
+        pixels.close()
+    return image
+
+def load_image(image_path, width=None, height=None, job_type="image_loader"):
+    """ Same as fstrip.load_image, but the decoding happens in the process pool of
+        `job_type`. Blocks until it's done, so call it from a worker thread
+    """
+    result = bgloader.run_in_process(job_type, decode_job, image_path, width, height)
+    if result is None:
+        return fstrip.load_image(image_path, width, height)
+    return wrap_pixels(*result)
+
+def decoder_for(job_type):
+    """ The load_image function that decodes the way `job_type` is configured to
+        (see bgloader.set_job_backend)
+    """
+    if bgloader.job_backend(job_type) != 'process' or not sharedmem.available():
+        return fstrip.load_image
+    return lambda image_path, width=None, height=None: load_image(image_path, width, height, job_type)
@@ -5,6 +5,11 @@
     High Level scrolling logic
 """    
 
+from array import array
+from bisect import bisect_right
+
+FORWARD, BACKWARD = 1, -1
+
 class ViewSettings(object):
     """ View settings hold information such as:
         zooming level
@@ -13,10 +18,13 @@ class ViewSettings(object):
 
         @param zoom_level: in percentage, i.e. 100 is unzoomed
         @param max_width: optional; if present, limits the zoom
+        @param fast_scaling: prefer cheap, low quality scaling (e.g. while the
+            user is still zooming)
     """
-    def __init__(self, zoom_level=100, max_width=None):
+    def __init__(self, zoom_level=100, max_width=None, fast_scaling=False):
         self.zoom_level = zoom_level
         self.max_width = max_width
+        self.fast_scaling = fast_scaling
 
     def transformed_width(self, width):
         """What the width should be according to this view setting"""
@@ -31,6 +39,9 @@ class ViewSettings(object):
     def set_zoom_level(self, zoom_level):
         self.zoom_level = zoom_level
 
+    def set_fast_scaling(self, fast):
+        self.fast_scaling = fast
+
 class IPage(object):
     """dummy class -- serves only as a documentation"""
     def get_height(self, view_settings):
@@ -41,6 +52,11 @@ class IPage(object):
     def is_loaded(self):
         """ Is the page loaded and ready for display? """
         raise NotImplemented
+    def has_size(self):
+        """ Do we know the size of the page? This can be true long before the
+            page is loaded; that's enough to lay it out and scroll across it
+        """
+        raise NotImplemented
 
 class IPageList(object):
     """ Interface for a partial view on a (potentially very huge) list of pages
@@ -51,8 +67,9 @@ class IPageList(object):
             @returns an IPage object
         """
         raise NotImplemented
-    def reset_window(self, index):
-        """ Load/Unload pages as needed, around `index`
+    def reset_window(self, index, direction=FORWARD):
+        """ Load/Unload pages as needed, around `index`, favoring pages in
+            `direction` (FORWARD or BACKWARD)
 
             @returns the new index of the object that index was pointing to
         """
@@ -60,28 +77,59 @@ class IPageList(object):
     def length(self):
         """ Length of the current view-list """
         raise NotImplemented
+    def heights(self):
+        """ HeightList of the (unzoomed) heights of all the pages in the list;
+            pages we don't know the size of yet count as 0
+        """
+        raise NotImplemented
+    def loaded_range(self, index):
+        """ The range of pages around index whose size we know; see get_loaded_range
+
+            @returns (first, end)
+        """
+        raise NotImplemented
 
-def get_loaded_context(page_list, index):
-    """ Get a sub list of pages that are loaded and reachable from index, 
+def load_priority(index, cursor_index, direction=FORWARD):
+    """ How urgent it is to load the page at `index`; lower is more urgent.
+
+        Pages are ranked by their distance from the cursor, but pages behind
+        the cursor (relative to the scroll direction) count double, because
+        the reader is moving away from them.
+    """
+    distance = index - cursor_index
+    if distance * direction >= 0:
+        return abs(distance)
+    return 2 * abs(distance)
+
+def get_loaded_range(page_list, index):
+    """ Get the range of pages that are loaded and reachable from index, 
         where reachable means all items between it and the item and index 
         are also loaded
 
-        @returns: (offset, list)
-            where offset is the index of the first item of the list
-            list is a list of the loaded pages
+        Here "loaded" only means we know the page size: that's all we need 
+        for layout; the pixels can come later
+
+        @returns: (first, end)
+            where first is the index of the first page in the range, and 
+            end is one past the last; first == end if the page at index 
+            itself isn't loaded
+    """
+    return page_list.loaded_range(index)
+
+def scan_loaded_range(page_list, index):
+    """ Find the loaded range around index by checking the pages one by one; 
+        a plain implementation of IPageList.loaded_range
     """
-    result = []
-    for i in range(index, page_list.length()):
-        page = page_list.page_at(i)
-        if not page.is_loaded(): break
-        result += [page]
-    offset = index
-    for i in range(index-1,-1,-1): # items before current index, in reverse
-        page = page_list.page_at(i)
-        if not page.is_loaded(): break
-        offset = i
-        result = [page] + result
-    return offset, result
+    length = page_list.length()
+    if not 0 <= index < length or not page_list.page_at(index).has_size():
+        return index, index
+    end = index + 1
+    while end < length and page_list.page_at(end).has_size():
+        end += 1
+    first = index
+    while first > 0 and page_list.page_at(first-1).has_size():
+        first -= 1
+    return first, end
 
 def is_page_available(page_list, index):
     return 0 <= index < page_list.length() and page_list.page_at(index).is_loaded()
@@ -98,6 +146,7 @@ class PageCursor(object):
         self.page_list = page_list
         self.index = index
         self.pixel = 0
+        self.direction = FORWARD # the direction of the last move
 
     def move(self, amount):
         """ Move the cursor `amount` pixels, where amount can be positive or 
@@ -107,8 +156,10 @@ class PageCursor(object):
 
             @returns: the amount of pixels actually moved
         """
+        if amount: 
+            self.direction = FORWARD if amount > 0 else BACKWARD
         amount_moved = self._move(amount) 
-        self.index = self.page_list.reset_window(self.index)
+        self.index = self.page_list.reset_window(self.index, self.direction)
         return amount_moved
 
     def _move(self, amount):
@@ -122,8 +173,9 @@ class PageCursor(object):
             space to move across, doing the move globally, then translating it
             to local coordinates again
         """
-        first_index, loaded_context = get_loaded_context(self.page_list, self.index)
-        heights = (page.get_height() for page in loaded_context)
+        first_index, end_index = get_loaded_range(self.page_list, self.index)
+        if first_index == end_index: return 0 # we don't even know the size of the current page
+        heights = self.page_list.heights()
 
         def minmax(low, val, max):
             if low > val:
@@ -132,31 +184,55 @@ class PageCursor(object):
                 return max
             return val
 
-        heights = HeightList(heights)
-
-        local_index = self.index - first_index
-        local_pixel = self.pixel
-        global_pixel = heights.local_to_global(local_index, local_pixel)
-        moved_global_pixel = minmax(0, global_pixel+amount, heights.max())
+        # we can only move across the loaded context
+        low = heights.local_to_global(first_index, 0)
+        high = heights.local_to_global(end_index, 0) - 1
+        global_pixel = heights.local_to_global(self.index, self.pixel)
+        moved_global_pixel = minmax(low, global_pixel+amount, high)
         amount_moved = moved_global_pixel - global_pixel
-        local_index, local_pixel = heights.global_to_local(moved_global_pixel)
 
         # apply the results of the calculations
-        self.index = first_index + local_index 
-        self.pixel = local_pixel
+        self.index, self.pixel = heights.global_to_local(moved_global_pixel)
         return amount_moved
 
 class HeightList(object):
-    def __init__(self, heights):
-        self.heights = list(heights)
+    """ The heights of a list of pages, kept as cumulative offsets so that
+        translating between (index, pixel) and global pixel positions is a 
+        lookup one way and a binary search the other way.
+
+        Pages can be added or removed at both ends without touching the other
+        offsets: the offsets are relative to an origin that's allowed to go 
+        negative, and global positions are measured from the first page.
+    """
+    def __init__(self, heights=()):
+        self.offsets = array('l', [0]) # offsets[i] is where item i starts; one more than the items
+        for height in heights:
+            self.append(height)
+    def __len__(self):
+        return len(self.offsets) - 1
+    def height(self, index):
+        return self.offsets[index+1] - self.offsets[index]
+    def append(self, height):
+        self.offsets.append(self.offsets[-1] + height)
+    def prepend(self, height):
+        self.offsets.insert(0, self.offsets[0] - height)
+    def pop(self):
+        """remove the last item"""
+        self.offsets.pop()
+    def popleft(self):
+        """remove the first item"""
+        self.offsets.pop(0)
+    def set_height(self, index, height):
+        delta = height - self.height(index)
+        for i in range(index+1, len(self.offsets)):
+            self.offsets[i] += delta
     def local_to_global(self, lindex, lpixel):
-        return sum(self.heights[:lindex]) + lpixel
+        return self.offsets[lindex] - self.offsets[0] + lpixel
     def global_to_local(self, pixel):
-        sum = 0
-        for i, h in enumerate(self.heights):
-            if sum + h > pixel: # this is it!
-                return i, pixel-sum
-            sum += h
+        """@returns: (index, pixel), or None if pixel is out of range"""
+        target = pixel + self.offsets[0]
+        index = bisect_right(self.offsets, target) - 1
+        if index < 0 or index >= len(self): return None
+        return index, target - self.offsets[index]
     def max(self):
-        return sum(self.heights)-1
-
+        return self.offsets[-1] - self.offsets[0] - 1
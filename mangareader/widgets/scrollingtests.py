@@ -6,7 +6,8 @@
 """
 
 import unittest
-from mangareader.widgets.scrolling import HeightList
+from mangareader.widgets.scrolling import (HeightList, PageCursor, ViewSettings,
+        scan_loaded_range, load_priority, FORWARD, BACKWARD)
 
 class TestHeightList(unittest.TestCase):
     def setUp(self):
@@ -24,7 +25,80 @@ class TestHeightList(unittest.TestCase):
         i, p = h.global_to_local(12)
         self.assertEqual( (i,p), (1,2) )
 
-        
-        
+    def testOutOfRange(self):
+        h = HeightList([10, 5, 10])
+        self.assertEqual(h.global_to_local(25), None)
+        self.assertEqual(h.global_to_local(-1), None)
+        self.assertEqual(h.global_to_local(24), (2, 9))
+
+    def testEdits(self):
+        h = HeightList([10, 5, 10])
+        h.prepend(20)
+        h.append(7)
+        self.assertEqual(len(h), 5)
+        self.assertEqual(h.max(), 51)
+        self.assertEqual(h.global_to_local(20), (1, 0))
+        self.assertEqual(h.local_to_global(4, 3), 48)
+        h.popleft()
+        h.pop()
+        self.assertEqual(h.global_to_local(12), (1, 2))
+        h.set_height(0, 4)
+        self.assertEqual(h.max(), 18)
+        self.assertEqual(h.local_to_global(2, 0), 9)
+        self.assertEqual(h.global_to_local(9), (2, 0))
+
+class FakePage(object):
+    def __init__(self, height):
+        self.height = height
+    def has_size(self):
+        return self.height is not None
+    def is_loaded(self):
+        return self.height is not None
+    def get_height(self, view_settings=None):
+        return self.height
+
+class FakePageList(object):
+    def __init__(self, heights):
+        self.pages = [FakePage(h) for h in heights]
+    def page_at(self, index):
+        return self.pages[index]
+    def length(self):
+        return len(self.pages)
+    def reset_window(self, index, direction=FORWARD):
+        return index
+    def heights(self):
+        return HeightList(page.height or 0 for page in self.pages)
+    def loaded_range(self, index):
+        return scan_loaded_range(self, index)
+
+class TestLoadedRange(unittest.TestCase):
+    def testRange(self):
+        pages = FakePageList([None, 10, 10, None, 10, 10, 10])
+        self.assertEqual(scan_loaded_range(pages, 1), (1, 3))
+        self.assertEqual(scan_loaded_range(pages, 5), (4, 7))
+        self.assertEqual(scan_loaded_range(pages, 3), (3, 3))
+
+class TestPageCursor(unittest.TestCase):
+    def testMoveAcrossPages(self):
+        cursor = PageCursor(FakePageList([100, 50, 100]), ViewSettings())
+        self.assertEqual(cursor.move(120), 120)
+        self.assertEqual((cursor.index, cursor.pixel), (1, 20))
+        self.assertEqual(cursor.move(-130), -120)
+        self.assertEqual((cursor.index, cursor.pixel), (0, 0))
+        self.assertEqual(cursor.direction, BACKWARD)
+
+    def testStopsAtPagesWithoutSize(self):
+        cursor = PageCursor(FakePageList([100, 50, None, 100]), ViewSettings())
+        self.assertEqual(cursor.move(1000), 149)
+        self.assertEqual((cursor.index, cursor.pixel), (1, 49))
+
+class TestLoadPriority(unittest.TestCase):
+    def testFavorsScrollDirection(self):
+        self.assertEqual(load_priority(5, 5), 0)
+        self.assertTrue(load_priority(6, 5, FORWARD) < load_priority(4, 5, FORWARD))
+        self.assertTrue(load_priority(4, 5, BACKWARD) < load_priority(6, 5, BACKWARD))
+        # distance still matters more than direction
+        self.assertTrue(load_priority(4, 5, FORWARD) < load_priority(9, 5, FORWARD))
+
 if __name__ == '__main__':
     unittest.main()